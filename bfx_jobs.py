@@ -0,0 +1,169 @@
+# ==============================================================================
+# BFX MANAGER - JOBS EM SEGUNDO PLANO (v118)
+# Fila de jobs no SQLite, atendida por workers em processos próprios. O servidor Streamlit só dispara o supervisor
+# (python -m bfx_jobs <pid do servidor>), que sobe os workers; nada roda em fork do servidor.
+# ==============================================================================
+import pandas as pd
+import sqlite3
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import os
+import sys
+import time
+import json
+import subprocess
+import multiprocessing
+
+from bfx_nucleo import (HAS_ARROW, HAS_FCNTL, conn, clean_str, data_iso, importar_vendas, calcular_dre_avancado, calcular_fluxo_caixa, calcular_relatorio_parceiro,
+                        gerar_pdf, ANALYTICS_DIR, atualizar_snapshot, atualizar_snapshot_periodico)
+if HAS_FCNTL: import fcntl
+
+JOBS_DIR = 'jobs_artefatos'; JOBS_WORKERS = 2
+JOBS_PIDFILE = os.path.join(JOBS_DIR, 'workers.pid'); JOBS_TRAVA = JOBS_PIDFILE + '.lock'
+JOBS_EM_PROCESSO = HAS_FCNTL  # sem travas entre processos (Windows) o job roda na própria requisição
+JOBS_RETENCAO_DIAS = 7; JOBS_BACKUPS_MANTIDOS = 3; JOBS_LIMPEZA_S = 3600
+
+class JobCancelado(Exception): pass
+
+class JobContexto:
+    def __init__(self, job_id): self.job_id = job_id
+    def arquivo(self, nome): os.makedirs(JOBS_DIR, exist_ok=True); return os.path.join(JOBS_DIR, f"job{self.job_id}_{nome}")
+    def progresso(self, pct, msg=None):
+        # Grava o progresso e interrompe se o admin pediu cancelamento. Faz commit: não chamar com escrita de dados do job
+        # pendente (a importação valida tudo antes e grava numa transação só no fim)
+        if conn.execute("SELECT cancelar FROM jobs WHERE id=?", (self.job_id,)).fetchone()[0]: raise JobCancelado()
+        conn.execute("UPDATE jobs SET progresso=?, mensagem=COALESCE(?, mensagem) WHERE id=?", (min(max(pct, 0.0), 1.0), msg, self.job_id)); conn.commit()
+
+def job_catalogo_pdf(ctx):
+    df_cat = pd.read_sql("SELECT nome, marca, valor_venda, imagem FROM produtos ORDER BY nome", conn)
+    if df_cat.empty: raise ValueError("Cadastre produtos com 'Valor de Venda' primeiro.")
+    ctx.progresso(0.1, f"Montando catálogo com {len(df_cat)} produtos...")
+    caminho = ctx.arquivo("Catalogo_Produtos.pdf")
+    with open(caminho, "wb") as f: f.write(gerar_pdf({'df': df_cat}, "catalogo"))
+    return caminho
+
+def job_importacao(ctx, arquivo):
+    df_imp = pd.read_csv(arquivo); os.remove(arquivo)  # o upload só serve a este job
+    total, sem_catalogo = importar_vendas(df_imp, ctx)
+    ctx.progresso(1.0, f"{total} linhas importadas" + (f"; {len(sem_catalogo)} com produto fora do catálogo (sem itens no ranking)" if len(sem_catalogo) else ""))
+    if sem_catalogo.empty: return None
+    caminho = ctx.arquivo("Importacao_sem_catalogo.pkl"); sem_catalogo.to_pickle(caminho)
+    return caminho
+
+def job_dre_periodo(ctx, meses=12):
+    hj = datetime.now(); linhas = []
+    for i in range(meses):
+        mes = (hj - relativedelta(months=i)).strftime("%Y-%m"); dre = calcular_dre_avancado(mes)
+        linhas.append({'Competência': mes, **{k: v for k, v in dre.items() if k != 'Detalhe'}, **dre['Detalhe']})
+        ctx.progresso((i + 1) / meses, f"DRE {mes}")
+    caminho = ctx.arquivo(f"DRE_{meses}m.pkl"); pd.DataFrame(linhas).to_pickle(caminho)
+    return caminho
+
+def job_fluxo_caixa(ctx):
+    caminho = ctx.arquivo("Fluxo_Caixa.pkl"); calcular_fluxo_caixa().to_pickle(caminho)
+    return caminho
+
+def job_relatorio_rh(ctx, empresa, mes):
+    df, total = calcular_relatorio_parceiro(empresa, mes); ctx.progresso(0.5, f"{len(df)} colaboradores")
+    caminho = ctx.arquivo(f"RH_{clean_str(mes)}.pdf")
+    with open(caminho, "wb") as f: f.write(gerar_pdf({'empresa': empresa, 'mes': mes, 'df': df, 'total': total}, "rh"))
+    return caminho
+
+def job_snapshot_analitico(ctx):
+    if not (HAS_ARROW and HAS_FCNTL): raise ValueError("Snapshot analítico indisponível: requer PyArrow e um sistema POSIX.")
+    os.makedirs(ANALYTICS_DIR, exist_ok=True)
+    with open(os.path.join(ANALYTICS_DIR, '.lock'), 'w') as trava:
+        fcntl.flock(trava, fcntl.LOCK_EX)
+        atualizar_snapshot()
+    ctx.progresso(1.0, "Snapshot analítico atualizado"); return None
+
+def job_backup(ctx):
+    caminho = ctx.arquivo(f"backup_{datetime.now().strftime('%Y%m%d_%H%M')}.db")
+    dst = sqlite3.connect(caminho); conn.backup(dst); dst.close()
+    return caminho
+
+JOBS = {'catalogo_pdf': job_catalogo_pdf, 'importacao': job_importacao, 'dre_periodo': job_dre_periodo, 'fluxo_caixa': job_fluxo_caixa, 'relatorio_rh': job_relatorio_rh, 'backup': job_backup, 'snapshot_analitico': job_snapshot_analitico}
+
+def reservar_job():
+    # UPDATE condicional: com vários workers, só um consegue trocar o status de 'pendente' para 'executando'
+    pid = os.getpid()
+    cur = conn.execute("UPDATE jobs SET status='executando', worker_pid=?, iniciado_em=? WHERE id=(SELECT id FROM jobs WHERE status='pendente' ORDER BY id LIMIT 1) AND status='pendente'", (pid, data_iso(datetime.now(), com_hora=True)))
+    conn.commit()
+    if cur.rowcount == 0: return None
+    return conn.execute("SELECT id, tipo, params FROM jobs WHERE status='executando' AND worker_pid=? ORDER BY id DESC LIMIT 1", (pid,)).fetchone()
+
+def executar_job(job_id, tipo, params):
+    ctx = JobContexto(job_id); agora = lambda: data_iso(datetime.now(), com_hora=True)
+    try:
+        caminho = JOBS[tipo](ctx, **json.loads(params or '{}'))
+        conn.execute("UPDATE jobs SET status='concluido', progresso=1, resultado_path=?, finalizado_em=? WHERE id=?", (caminho, agora(), job_id))
+    except JobCancelado:
+        conn.rollback(); conn.execute("UPDATE jobs SET status='cancelado', mensagem='Cancelado pelo usuário', finalizado_em=? WHERE id=?", (agora(), job_id))
+    except Exception as e:
+        conn.rollback(); conn.execute("UPDATE jobs SET status='erro', mensagem=?, finalizado_em=? WHERE id=?", (str(e), agora(), job_id))
+    conn.commit()
+
+def worker_loop(ppid):
+    # Processo filho do supervisor; a conexão é a do módulo (aberta neste processo ao importar bfx_nucleo)
+    while os.getppid() == ppid:
+        job = reservar_job()
+        if job: executar_job(*job)
+        else: atualizar_snapshot_periodico(); time.sleep(1)
+
+def pid_vivo(pid):
+    try: os.kill(int(pid), 0); return True
+    except PermissionError: return True
+    except (OSError, TypeError, ValueError): return False
+
+def limpar_artefatos():
+    # Retenção de jobs_artefatos/: job finalizado há mais de JOBS_RETENCAO_DIAS sai da fila junto com o arquivo; dos backups (cópia
+    # inteira do banco cada) ficam os JOBS_BACKUPS_MANTIDOS mais recentes; arquivo antigo sem job (upload de job cancelado) também sai
+    os.makedirs(JOBS_DIR, exist_ok=True); limite = data_iso(datetime.now() - timedelta(days=JOBS_RETENCAO_DIAS), com_hora=True)
+    backups = conn.execute("SELECT id, resultado_path FROM jobs WHERE tipo='backup' AND resultado_path IS NOT NULL ORDER BY id DESC LIMIT -1 OFFSET ?", (JOBS_BACKUPS_MANTIDOS,)).fetchall()
+    expirados = conn.execute("SELECT id, resultado_path FROM jobs WHERE status NOT IN ('pendente', 'executando') AND COALESCE(finalizado_em, criado_em) < ?", (limite,)).fetchall()
+    for _, caminho in backups + expirados:
+        if caminho and os.path.exists(caminho): os.remove(caminho)
+    conn.executemany("UPDATE jobs SET resultado_path=NULL, mensagem='Arquivo removido: só os backups mais recentes ficam guardados' WHERE id=?", [(j,) for j, _ in backups])
+    conn.executemany("DELETE FROM jobs WHERE id=?", [(j,) for j, _ in expirados]); conn.commit()
+    for nome in os.listdir(JOBS_DIR):
+        caminho = os.path.join(JOBS_DIR, nome)
+        if caminho not in (JOBS_PIDFILE, JOBS_TRAVA) and os.path.isfile(caminho) and time.time() - os.path.getmtime(caminho) > JOBS_RETENCAO_DIAS * 86400: os.remove(caminho)
+
+def supervisionar(pid_servidor):
+    # Dono da trava e do arquivo de pid (1ª linha = supervisor, demais = workers). Workers sobem com 'spawn': processo novo,
+    # sem herdar sockets, threads ou travas do servidor Streamlit. Repõe os que morrem e sai quando o servidor encerra
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(JOBS_TRAVA, 'a') as trava:
+        try: fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: return  # outro supervisor já atende a fila
+        ctx = multiprocessing.get_context('spawn'); workers = []; proxima_limpeza = 0
+        while os.getppid() == pid_servidor:
+            backups = conn.execute("SELECT COUNT(*) FROM jobs WHERE tipo='backup' AND resultado_path IS NOT NULL").fetchone()[0]
+            if time.time() >= proxima_limpeza or backups > JOBS_BACKUPS_MANTIDOS:  # backup novo: poda na hora, não só na rodada horária
+                try: limpar_artefatos()
+                except (OSError, sqlite3.Error): conn.rollback()
+                proxima_limpeza = time.time() + JOBS_LIMPEZA_S
+            workers = [p for p in workers if p.is_alive()]
+            if len(workers) < JOBS_WORKERS:
+                for jid, wpid in conn.execute("SELECT id, worker_pid FROM jobs WHERE status='executando'").fetchall():
+                    if not pid_vivo(wpid): conn.execute("UPDATE jobs SET status='erro', mensagem='Interrompido (worker encerrado)' WHERE id=?", (jid,))
+                conn.commit()
+                for _ in range(JOBS_WORKERS - len(workers)):
+                    p = ctx.Process(target=worker_loop, args=(os.getpid(),), daemon=True); p.start(); workers.append(p)
+                with open(JOBS_PIDFILE, 'w') as f: f.write("\n".join(map(str, [os.getpid()] + [p.pid for p in workers])))
+            time.sleep(2)
+
+def iniciar_workers():
+    # Chamado a cada rerun da interface: trava livre = nenhum supervisor vivo, então sobe um (python -m bfx_jobs <pid>).
+    # Duas sessões podem disparar juntas; o supervisor que não pega a trava sai sozinho
+    if not JOBS_EM_PROCESSO: return
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(JOBS_TRAVA, 'a') as trava:
+        try: fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: return
+        fcntl.flock(trava, fcntl.LOCK_UN)
+    caminho = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')]))
+    subprocess.Popen([sys.executable, '-m', 'bfx_jobs', str(os.getpid())], env={**os.environ, 'PYTHONPATH': caminho}, stdin=subprocess.DEVNULL, start_new_session=True)
+
+if __name__ == '__main__':
+    supervisionar(int(sys.argv[1]))
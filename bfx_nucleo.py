@@ -0,0 +1,601 @@
+# ==============================================================================
+# BFX MANAGER - NÚCLEO (v123)
+# Banco, regras de negócio, PDF e snapshot analítico, sem Streamlit: importado pela interface (sistema_bfx.py)
+# e pelos workers de jobs (bfx_jobs.py), que rodam em processos próprios.
+# ==============================================================================
+import pandas as pd
+import sqlite3
+from datetime import datetime, timedelta, date
+from dateutil.relativedelta import relativedelta
+from fpdf import FPDF
+import os
+import time
+import base64
+import re
+import json
+import shutil
+
+# Tenta importar PyArrow (snapshot analítico colunar)
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    HAS_ARROW = True
+except ImportError:
+    HAS_ARROW = False
+
+# Tenta importar fcntl (travas entre processos, só POSIX): sem ele não há workers nem snapshot analítico
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+# ==============================================================================
+# 1. BANCO DE DADOS
+# ==============================================================================
+DB_PATH = 'bfx_sistema.db'
+def get_connection():
+    c = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    c.execute("PRAGMA journal_mode=WAL")  # leitores (relatórios/jobs) não bloqueiam as vendas
+    return c
+conn = get_connection()  # uma por processo: a interface divide esta entre as sessões; cada worker abre a sua ao importar o módulo
+
+SNAPSHOT_TABELAS = {
+    'vendas': [('id', 'INTEGER'), ('data_venda', 'TEXT'), ('dia_ord', 'INTEGER'), ('vendedor', 'TEXT'), ('cliente_id', 'INTEGER'), ('produto_nome', 'TEXT'), ('custo_produto', 'REAL'), ('valor_venda', 'REAL'),
+               ('valor_frete', 'REAL'), ('custo_envio', 'REAL'), ('parcelas', 'INTEGER'), ('valor_parcela', 'REAL'), ('lucro_liquido', 'REAL'), ('antecipada', 'INTEGER')],
+    'despesas': [('id', 'INTEGER'), ('data_despesa', 'TEXT'), ('dia_ord', 'INTEGER'), ('descricao', 'TEXT'), ('categoria', 'TEXT'), ('valor', 'REAL'), ('tipo', 'TEXT')]
+}
+SNAPSHOT_PARTICIONADAS = ('vendas', 'despesas')  # particionadas por ano_mes
+
+def init_db():
+    c = conn.cursor()
+    tables = [
+        '''CREATE TABLE IF NOT EXISTS clientes (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, renda REAL, empresa TEXT, matricula TEXT, telefone TEXT, cpf TEXT, cnpj TEXT, tipo TEXT, data_nascimento DATE, cep TEXT, endereco TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS produtos (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, custo_padrao REAL, marca TEXT, categoria TEXT, ncm TEXT, imagem TEXT, fornecedor_id INTEGER, qtd_estoque INTEGER DEFAULT 0, valor_venda REAL DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS vendas (id INTEGER PRIMARY KEY AUTOINCREMENT, data_venda DATE, vendedor TEXT, cliente_id INTEGER, produto_nome TEXT, custo_produto REAL, valor_venda REAL, valor_frete REAL DEFAULT 0, custo_envio REAL DEFAULT 0, parcelas INTEGER, valor_parcela REAL, taxa_financeira_valor REAL, lucro_liquido REAL, antecipada INTEGER DEFAULT 1, excedeu_limite INTEGER DEFAULT 0, comprovante_pdf TEXT, FOREIGN KEY(cliente_id) REFERENCES clientes(id))''',
+        '''CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY AUTOINCREMENT, modelo_contrato TEXT, logo_path TEXT, openai_key TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT, role TEXT, nome_exibicao TEXT, email TEXT, telefone TEXT, data_nascimento DATE, endereco TEXT, cep TEXT, meta_mensal REAL DEFAULT 50000.0, comissao_pct REAL DEFAULT 2.0)''',
+        '''CREATE TABLE IF NOT EXISTS fornecedores (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, telefone TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS empresas_parceiras (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, responsavel_rh TEXT, telefone_rh TEXT, email_rh TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS pagamentos (id INTEGER PRIMARY KEY AUTOINCREMENT, data_pagamento DATE, vendedor TEXT, valor REAL, obs TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS audit_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, data_hora DATETIME, usuario TEXT, acao TEXT, detalhes TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS despesas (id INTEGER PRIMARY KEY AUTOINCREMENT, data_despesa DATE, descricao TEXT, categoria TEXT, valor REAL, tipo TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS avisos (id INTEGER PRIMARY KEY AUTOINCREMENT, data_criacao DATETIME, mensagem TEXT, ativo INTEGER DEFAULT 1)''',
+        '''CREATE TABLE IF NOT EXISTS vendas_itens (id INTEGER PRIMARY KEY AUTOINCREMENT, venda_id INTEGER, produto_id INTEGER, data_venda DATE, quantidade INTEGER DEFAULT 1, custo_unit REAL, preco_unit REAL, FOREIGN KEY(venda_id) REFERENCES vendas(id), FOREIGN KEY(produto_id) REFERENCES produtos(id))''',
+        '''CREATE TABLE IF NOT EXISTS migracoes (nome TEXT PRIMARY KEY, data_hora DATETIME, erro TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS despesas_recorrentes (id INTEGER PRIMARY KEY AUTOINCREMENT, descricao TEXT, categoria TEXT, valor REAL, tipo TEXT, data_inicio DATE, intervalo_meses INTEGER DEFAULT 1, data_fim DATE, qtd_ocorrencias INTEGER, ativo INTEGER DEFAULT 1)''',
+        '''CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, tipo TEXT, params TEXT, status TEXT DEFAULT 'pendente', progresso REAL DEFAULT 0, mensagem TEXT, cancelar INTEGER DEFAULT 0, resultado_path TEXT, usuario TEXT, worker_pid INTEGER, criado_em DATETIME, iniciado_em DATETIME, finalizado_em DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS ncm_apelidos (termo TEXT PRIMARY KEY, ncm TEXT, usos INTEGER DEFAULT 1, atualizado_em DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS analytics_pendencias (id INTEGER PRIMARY KEY AUTOINCREMENT, tabela TEXT, ano_mes INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS despesas_recorrentes_excecoes (id INTEGER PRIMARY KEY AUTOINCREMENT, regra_id INTEGER, ano_mes INTEGER, valor REAL, cancelada INTEGER DEFAULT 0, UNIQUE(regra_id, ano_mes), FOREIGN KEY(regra_id) REFERENCES despesas_recorrentes(id))'''
+    ]
+    for sql in tables: c.execute(sql)
+    indices = [
+        "CREATE INDEX IF NOT EXISTS idx_itens_produto ON vendas_itens (produto_id, data_venda)",
+        "CREATE INDEX IF NOT EXISTS idx_itens_data ON vendas_itens (data_venda)",
+        "CREATE INDEX IF NOT EXISTS idx_itens_venda ON vendas_itens (venda_id)",
+        "CREATE INDEX IF NOT EXISTS idx_recorrentes_periodo ON despesas_recorrentes (data_inicio, data_fim)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)"
+    ]
+    for sql in indices: c.execute(sql)
+
+    def force_add_column(table, col, dtype):
+        try:
+            existing_cols = [i[1] for i in c.execute(f"PRAGMA table_info({table})")]
+            if col not in existing_cols: c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {dtype}")
+        except: pass
+
+    force_add_column('clientes', 'cnpj', 'TEXT')
+    force_add_column('clientes', 'tipo', 'TEXT')
+    force_add_column('produtos', 'valor_venda', 'REAL DEFAULT 0')
+    force_add_column('vendas', 'comprovante_pdf', 'TEXT')
+    force_add_column('config', 'openai_key', 'TEXT')
+    force_add_column('migracoes', 'erro', 'TEXT')
+
+    # Colunas inteiras geradas a partir das datas ISO: filtros mensais/por período viram range scan no índice (v116)
+    for tabela, col in [('vendas', 'data_venda'), ('despesas', 'data_despesa')]:
+        force_add_column(tabela, 'ano_mes', f"INTEGER GENERATED ALWAYS AS (CAST(strftime('%Y%m', {col}) AS INTEGER)) VIRTUAL")
+        force_add_column(tabela, 'dia_ord', f"INTEGER GENERATED ALWAYS AS (CAST(julianday({col}) - 1721424.5 AS INTEGER)) VIRTUAL")
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabela}_ano_mes ON {tabela} (ano_mes)")
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabela}_dia_ord ON {tabela} (dia_ord)")
+    # Validação na escrita: só aceita AAAA-MM-DD (datas) e AAAA-MM-DD HH:MM:SS (data/hora)
+    for tabela, col, func in [('vendas', 'data_venda', 'date'), ('vendas_itens', 'data_venda', 'date'), ('despesas', 'data_despesa', 'date'), ('audit_logs', 'data_hora', 'datetime')]:
+        for evento, sufixo in [('INSERT', 'ins'), (f'UPDATE OF {col}', 'upd')]:
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabela}_{col}_{sufixo} BEFORE {evento} ON {tabela} WHEN NEW.{col} IS NOT {func}(NEW.{col}) BEGIN SELECT RAISE(ABORT, 'Data fora do padrão ISO em {tabela}.{col}'); END")
+
+    try:
+        c.execute("UPDATE usuarios SET password = '123' WHERE username = 'bruno'")
+        if c.execute("SELECT count(*) FROM usuarios WHERE username='bruno'").fetchone()[0] == 0:
+             c.execute("INSERT INTO usuarios (username, password, role, nome_exibicao) VALUES ('bruno', '123', 'vendedor', 'Bruno')")
+    except: pass
+
+    if c.execute("SELECT count(*) FROM usuarios WHERE username='admin'").fetchone()[0] == 0:
+        c.execute("INSERT INTO usuarios (username, password, role, nome_exibicao) VALUES ('admin', 'admin', 'admin', 'Administrador')")
+    
+    for emp in ["Amazon Five", "Gimam"]:
+        if c.execute("SELECT count(*) FROM empresas_parceiras WHERE nome=?", (emp,)).fetchone()[0] == 0:
+            c.execute("INSERT INTO empresas_parceiras (nome, responsavel_rh, telefone_rh, email_rh) VALUES (?,?,?,?)", (emp, "RH "+emp, "", ""))
+    if c.execute("SELECT COUNT(*) FROM config").fetchone()[0] == 0:
+        c.execute("INSERT INTO config (modelo_contrato, logo_path) VALUES (?, ?)", ("Texto Padrão...", ""))
+    conn.commit()
+    # Alterações/exclusões marcam o mês afetado para o snapshot analítico reescrever só essa partição (v120)
+    for tabela in SNAPSHOT_TABELAS:
+        velho, novo = ("COALESCE(OLD.ano_mes, 0)", "COALESCE(NEW.ano_mes, 0)") if tabela in SNAPSHOT_PARTICIONADAS else ("0", "0")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabela}_analytics_upd AFTER UPDATE ON {tabela} BEGIN INSERT INTO analytics_pendencias (tabela, ano_mes) VALUES ('{tabela}', {velho}), ('{tabela}', {novo}); END")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabela}_analytics_del AFTER DELETE ON {tabela} BEGIN INSERT INTO analytics_pendencias (tabela, ano_mes) VALUES ('{tabela}', {velho}); END")
+    conn.commit()
+    executar_migracao("normalizar_datas_iso", normalizar_datas)
+    executar_migracao("backfill_vendas_itens", backfill_vendas_itens)
+    executar_migracao("backfill_vendas_itens_nomes_compostos", backfill_vendas_itens)  # refaz as vendas puladas quando o produto tinha " + " no nome
+    executar_migracao("colapsar_despesas_recorrentes", colapsar_despesas_recorrentes)
+    executar_migracao("remover_snapshot_clientes", remover_snapshot_clientes)
+
+# ITENS DE VENDA NORMALIZADOS (v115)
+def executar_migracao(nome, func):
+    # Roda cada migração de dados uma única vez (controle na tabela migracoes). Falha é desfeita e registrada em migracoes.erro,
+    # sem nova tentativa a cada rerun; para rodar de novo, apague a linha da migração
+    if conn.execute("SELECT 1 FROM migracoes WHERE nome=?", (nome,)).fetchone(): return
+    try: func(); erro = None
+    except Exception as e: conn.rollback(); erro = f"{type(e).__name__}: {e}"
+    conn.execute("INSERT INTO migracoes (nome, data_hora, erro) VALUES (?,?,?)", (nome, data_iso(datetime.now(), com_hora=True), erro)); conn.commit()
+
+def mapa_produtos():
+    df = pd.read_sql("SELECT id, nome, custo_padrao, valor_venda FROM produtos", conn)
+    return {str(r['nome']).strip().upper(): r for _, r in df.iterrows()}
+
+def ratear_itens(prods, custo_total, valor_total):
+    # Agrupa produtos repetidos e distribui custo/valor da venda proporcionalmente ao catálogo
+    grupos = {}
+    for p in prods:
+        pid = int(p['id'])
+        if pid in grupos: grupos[pid]['qtd'] += 1
+        else: grupos[pid] = {'qtd': 1, 'custo': float(p['custo_padrao'] or 0), 'preco': float(p['valor_venda'] or 0)}
+    if not grupos: return []
+    def pesos(campo):
+        tot = sum(g[campo] * g['qtd'] for g in grupos.values())
+        return {pid: (g[campo] * g['qtd'] / tot if tot > 0 else g['qtd'] / len(prods)) for pid, g in grupos.items()}
+    w_custo = pesos('custo'); w_preco = pesos('preco') if any(g['preco'] > 0 for g in grupos.values()) else w_custo
+    return [(pid, g['qtd'], (custo_total or 0.0) * w_custo[pid] / g['qtd'], (valor_total or 0.0) * w_preco[pid] / g['qtd']) for pid, g in grupos.items()]
+
+def registrar_itens_venda(venda_id, data_venda, itens, baixar_estoque=True):
+    # Não faz commit: roda na mesma transação do INSERT da venda
+    conn.executemany("INSERT INTO vendas_itens (venda_id, produto_id, data_venda, quantidade, custo_unit, preco_unit) VALUES (?,?,?,?,?,?)",
+                     [(venda_id, pid, data_iso(data_venda), qtd, cu, pu) for pid, qtd, cu, pu in itens])
+    if baixar_estoque: conn.executemany("UPDATE produtos SET qtd_estoque = COALESCE(qtd_estoque, 0) - ? WHERE id=?", [(qtd, pid) for pid, qtd, _, _ in itens])
+
+def itens_por_nome(texto, mapa):
+    # Casa "PROD A + PROD B" com produtos.nome; retorna None se algum trecho não for encontrado.
+    # O nome inteiro vem primeiro e depois o trecho mais longo a cada posição: há produtos com " + " no próprio nome ("CABO + FONTE A GOLD")
+    inteiro = str(texto or "").strip().upper()
+    if inteiro in mapa: return [mapa[inteiro]]
+    partes = [n.strip().upper() for n in inteiro.split(" + ") if n.strip()]; prods = []; i = 0
+    while i < len(partes):
+        j = next((j for j in range(len(partes), i, -1) if " + ".join(partes[i:j]) in mapa), None)
+        if j is None: return None
+        prods.append(mapa[" + ".join(partes[i:j])]); i = j
+    return prods or None
+
+def backfill_vendas_itens():
+    mapa = mapa_produtos()
+    df = pd.read_sql("SELECT id, data_venda, produto_nome, custo_produto, valor_venda FROM vendas WHERE id NOT IN (SELECT venda_id FROM vendas_itens)", conn)
+    for _, r in df.iterrows():
+        prods = itens_por_nome(r['produto_nome'], mapa)
+        if not prods: continue
+        try: registrar_itens_venda(int(r['id']), r['data_venda'], ratear_itens(prods, r['custo_produto'], r['valor_venda']), baixar_estoque=False)
+        except ValueError: continue
+
+def calcular_ranking_produtos(d_ini, d_fim, vendedores=None):
+    # Agregado indexado por produto (idx_itens_data / idx_itens_produto): receita, margem e giro de estoque
+    q = """SELECT p.nome as produto, SUM(i.quantidade) as qtd, SUM(i.quantidade*i.preco_unit) as receita,
+           SUM(i.quantidade*(i.preco_unit-i.custo_unit)) as margem, p.qtd_estoque
+           FROM vendas_itens i JOIN produtos p ON p.id = i.produto_id"""
+    params = [str(d_ini), str(d_fim)]
+    if vendedores:
+        q += f" JOIN vendas v ON v.id = i.venda_id WHERE i.data_venda BETWEEN ? AND ? AND v.vendedor IN ({','.join('?'*len(vendedores))})"; params += list(vendedores)
+    else: q += " WHERE i.data_venda BETWEEN ? AND ?"
+    df = pd.read_sql(q + " GROUP BY i.produto_id ORDER BY qtd DESC", conn, params=params)
+    df['margem_pct'] = (df['margem'] / df['receita'] * 100).where(df['receita'] > 0, 0.0)
+    df['giro'] = df['qtd'] / df['qtd_estoque'].where(df['qtd_estoque'] > 0)
+    return df
+
+# DATAS ISO (v116)
+def data_iso(v, com_hora=False):
+    # date/datetime/texto (ISO ou DD/MM/AAAA) -> 'AAAA-MM-DD' ou 'AAAA-MM-DD HH:MM:SS'; ValueError se inválido
+    if isinstance(v, datetime): d = v
+    elif isinstance(v, date): d = datetime(v.year, v.month, v.day)
+    else:
+        txt = str(v).strip()
+        for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d', '%d/%m/%Y %H:%M', '%d/%m/%Y'):
+            try: d = datetime.strptime(txt, fmt); break
+            except ValueError: continue
+        else: raise ValueError(f"Data inválida: {v}")
+    return d.strftime('%Y-%m-%d %H:%M:%S') if com_hora else d.strftime('%Y-%m-%d')
+
+def ano_mes_int(mes_ano): return int(str(mes_ano)[:7].replace('-', ''))  # '2026-01' -> 202601
+def mes_idx(ano_mes): return (ano_mes // 100) * 12 + ano_mes % 100 - 1  # meses corridos, aceita int ou Series
+def inicio_parcelas(df): return mes_idx(df['ano_mes']) + 1 + (df['dia'] > 20).astype(int)  # 1ª parcela: mês seguinte (até dia 20) ou o outro
+
+def normalizar_datas():
+    # Passada única: reescreve datas gravadas como date/datetime/CSV no padrão ISO estrito (valores ilegíveis ficam como estão)
+    for tabela, col, com_hora in [('vendas', 'data_venda', False), ('vendas_itens', 'data_venda', False), ('despesas', 'data_despesa', False), ('audit_logs', 'data_hora', True)]:
+        updates = []
+        for rid, val in conn.execute(f"SELECT id, {col} FROM {tabela} WHERE {col} IS NOT NULL").fetchall():
+            try: novo = data_iso(val, com_hora)
+            except ValueError: continue
+            if novo != val: updates.append((novo, rid))
+        conn.executemany(f"UPDATE {tabela} SET {col}=? WHERE id=?", updates)
+
+# DESPESAS RECORRENTES POR REGRA (v117)
+def expandir_recorrencias(am_ini, am_fim):
+    # Gera só as ocorrências dentro de [am_ini, am_fim] (AAAAMM): custo proporcional aos meses pedidos, não ao tamanho da série
+    idx_ini, idx_fim = mes_idx(am_ini), mes_idx(am_fim)
+    # 'AAAA-MM-31' serve de teto textual para qualquer data ISO do mês final. Regras encerradas (ativo=0) continuam gerando
+    # os meses até data_fim: o histórico do DRE/fluxo não muda quando uma regra é alterada ou encerrada
+    regras = conn.execute("SELECT id, descricao, categoria, valor, tipo, data_inicio, intervalo_meses, data_fim, qtd_ocorrencias FROM despesas_recorrentes WHERE data_inicio <= ? AND (data_fim IS NULL OR data_fim >= ?)",
+                          (f"{am_fim // 100:04d}-{am_fim % 100:02d}-31", f"{am_ini // 100:04d}-{am_ini % 100:02d}-01")).fetchall()
+    if not regras: return
+    excecoes = {(r, am): (v, canc) for r, am, v, canc in conn.execute("SELECT regra_id, ano_mes, valor, cancelada FROM despesas_recorrentes_excecoes WHERE ano_mes BETWEEN ? AND ?", (am_ini, am_fim))}
+    for rid, desc, cat, valor, tipo, d_ini, intervalo, d_fim, qtd in regras:
+        inicio = date.fromisoformat(d_ini); passo = max(int(intervalo or 1), 1)
+        k = max(0, -(-(idx_ini - mes_idx(inicio.year * 100 + inicio.month)) // passo))  # 1ª ocorrência >= am_ini
+        while not (qtd and k >= qtd):
+            d = inicio + relativedelta(months=k * passo); am = d.year * 100 + d.month
+            if mes_idx(am) > idx_fim or (d_fim and data_iso(d) > d_fim): break
+            v_exc, canc = excecoes.get((rid, am), (None, 0))
+            if not canc:
+                yield {'regra_id': rid, 'data_despesa': data_iso(d), 'ano_mes': am, 'descricao': f"{desc} ({k+1}/{qtd})" if qtd else desc,
+                       'categoria': cat, 'valor': valor if v_exc is None else v_exc, 'tipo': tipo}
+            k += 1
+
+def despesas_periodo(am_ini, am_fim):
+    # Despesas avulsas (range scan em idx_despesas_ano_mes) + ocorrências das regras, agregadas por mês e tipo
+    df = ler_analitico('despesas', ['ano_mes', 'tipo', 'valor'], lambda f: (f('ano_mes') >= am_ini) & (f('ano_mes') <= am_fim),
+                       "SELECT ano_mes, tipo, valor FROM despesas WHERE ano_mes BETWEEN ? AND ?", (am_ini, am_fim))
+    df = df.groupby(['ano_mes', 'tipo'], as_index=False, dropna=False)['valor'].sum().rename(columns={'valor': 'total'})
+    rec = pd.DataFrame(list(expandir_recorrencias(am_ini, am_fim)), columns=['ano_mes', 'tipo', 'valor'])
+    if rec.empty: return df
+    rec = rec.groupby(['ano_mes', 'tipo'], as_index=False)['valor'].sum().rename(columns={'valor': 'total'})
+    return pd.concat([df, rec]).groupby(['ano_mes', 'tipo'], as_index=False, dropna=False)['total'].sum()
+
+def encerrar_regra(r_id, am):
+    # Sem ocorrências a partir de am (AAAAMM); as anteriores ficam. ativo=0 tira a regra da lista de regras vigentes
+    fim = data_iso(date(am // 100, am % 100, 1) - timedelta(days=1))
+    conn.execute("UPDATE despesas_recorrentes SET data_fim=CASE WHEN data_fim IS NOT NULL AND data_fim < ? THEN data_fim ELSE ? END, ativo=0 WHERE id=?", (fim, fim, r_id))
+
+def versionar_regra(r_id, am, descricao, valor, tipo, qtd):
+    # Alteração vale de am em diante: encerra a regra atual no mês anterior e cria a continuação com os novos valores
+    # (exceções de am em diante vão junto). qtd conta as ocorrências desta regra desde o seu início. Retorna o id da regra vigente (None se a série já acabou)
+    d_ini, passo, qtd_atual, d_fim, cat = conn.execute("SELECT data_inicio, intervalo_meses, qtd_ocorrencias, data_fim, categoria FROM despesas_recorrentes WHERE id=?", (r_id,)).fetchone()
+    inicio = date.fromisoformat(d_ini); passo = max(int(passo or 1), 1)
+    k0 = max(0, -(-(mes_idx(am) - mes_idx(inicio.year * 100 + inicio.month)) // passo))  # ocorrências antes de am
+    if k0 == 0:
+        conn.execute("UPDATE despesas_recorrentes SET descricao=?, valor=?, tipo=?, qtd_ocorrencias=? WHERE id=?", (descricao, valor, tipo, qtd, r_id)); return r_id
+    encerrar_regra(r_id, am)
+    if qtd and qtd <= k0: return None
+    cur = conn.execute("INSERT INTO despesas_recorrentes (descricao, categoria, valor, tipo, data_inicio, intervalo_meses, data_fim, qtd_ocorrencias) VALUES (?,?,?,?,?,?,?,?)",
+                       (descricao, cat, valor, tipo, data_iso(inicio + relativedelta(months=k0 * passo)), passo, d_fim, qtd - k0 if qtd else None))
+    conn.execute("UPDATE despesas_recorrentes_excecoes SET regra_id=? WHERE regra_id=? AND ano_mes>=?", (cur.lastrowid, r_id, am))
+    return cur.lastrowid
+
+def colapsar_despesas_recorrentes():
+    # Converte séries antigas "Descrição (i/N)" (uma linha física por mês) em uma regra + exceções
+    df = pd.read_sql("SELECT id, data_despesa, descricao, categoria, valor, tipo FROM despesas", conn)
+    partes = df['descricao'].fillna('').str.extract(r'^(.*) \((\d+)/(\d+)\)$')
+    df['base'] = partes[0]; df['n'] = pd.to_numeric(partes[1]); df['total_n'] = pd.to_numeric(partes[2])
+    df = df.dropna(subset=['base', 'data_despesa'])
+    for (base, total_n, tipo), g in df.groupby(['base', 'total_n', df['tipo'].fillna('')]):
+        total_n = int(total_n)
+        if g['n'].duplicated().any() or len(g) < 2: continue
+        primeira = g.sort_values('n').iloc[0]
+        try: inicio = date.fromisoformat(primeira['data_despesa']) - relativedelta(months=int(primeira['n']) - 1)
+        except (TypeError, ValueError): continue  # data que normalizar_datas não conseguiu ler: série fica como linhas físicas
+        # Só colapsa se todas as datas batem com o calendário mensal da série
+        if any(data_iso(inicio + relativedelta(months=int(r['n']) - 1)) != r['data_despesa'] for _, r in g.iterrows()): continue
+        valor = g['valor'].mode().iloc[0]
+        cur = conn.execute("INSERT INTO despesas_recorrentes (descricao, categoria, valor, tipo, data_inicio, intervalo_meses, qtd_ocorrencias) VALUES (?,?,?,?,?,1,?)",
+                           (base, primeira['categoria'], valor, tipo or None, data_iso(inicio), total_n))
+        excecoes = [(cur.lastrowid, int(r['data_despesa'][:7].replace('-', '')), r['valor'], 0) for _, r in g.iterrows() if r['valor'] != valor]
+        existentes = set(g['n'].astype(int))
+        excecoes += [(cur.lastrowid, int(data_iso(inicio + relativedelta(months=n - 1))[:7].replace('-', '')), None, 1) for n in range(1, total_n + 1) if n not in existentes]
+        conn.executemany("INSERT INTO despesas_recorrentes_excecoes (regra_id, ano_mes, valor, cancelada) VALUES (?,?,?,?)", excecoes)
+        conn.executemany("DELETE FROM despesas WHERE id=?", [(int(i),) for i in g['id']])
+
+# ==============================================================================
+# 2. UTILITÁRIOS, RELATÓRIOS E PDF
+# ==============================================================================
+def clean_str(val): return re.sub(r'\D', '', str(val)) if val else ""
+def format_brl(v): return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if v else "R$ 0,00"
+
+def check_credito(cli_id, parc_nova):
+    res = pd.read_sql(f"SELECT renda FROM clientes WHERE id={cli_id}", conn)
+    if res.empty: return True, 0, 0, 0
+    teto = min(res.iloc[0]['renda']*0.30, 475.00)
+    vendas = pd.read_sql("SELECT ano_mes, CAST(substr(data_venda, 9, 2) AS INTEGER) as dia, parcelas, valor_parcela FROM vendas WHERE cliente_id=?", conn, params=(int(cli_id),))
+    hj = datetime.now().date(); atual = mes_idx(hj.year * 100 + hj.month); ini = inicio_parcelas(vendas)
+    tomado = float(vendas.loc[(ini <= atual) & (atual < ini + vendas['parcelas']), 'valor_parcela'].sum())
+    return (tomado+parc_nova) <= (teto+1.0), teto-tomado, tomado, teto
+
+def calcular_dre_avancado(mes_ano):
+    am = ano_mes_int(mes_ano)
+    cols = ['vendedor', 'valor_venda', 'valor_frete', 'custo_produto', 'custo_envio']
+    df_v = ler_analitico('vendas', cols, lambda f: f('ano_mes') == am, f"SELECT {', '.join(cols)} FROM vendas WHERE ano_mes=?", (am,))
+    df_v['total'] = df_v['valor_venda'] + df_v['valor_frete']  # NULL em qualquer parcela anula a linha, como no SUM do SQL
+    receita_bruta = float(df_v['total'].sum()); cmv = float(df_v['custo_produto'].sum()); custo_frete_real = float(df_v['custo_envio'].sum())
+    df_vends = df_v.groupby('vendedor', dropna=False, as_index=False)['total'].sum(); comissoes = 0.0
+    for _, r in df_vends.iterrows():
+        pct = conn.execute("SELECT comissao_pct FROM usuarios WHERE nome_exibicao=?", (r['vendedor'],)).fetchone()
+        comissoes += r['total'] * ((pct[0] if pct else 2.0) / 100.0)
+    df_desp = despesas_periodo(am, am)
+    custo_fixo = df_desp[df_desp['tipo']=='Fixa']['total'].sum() if not df_desp.empty else 0.0
+    desp_var = df_desp[df_desp['tipo']=='Variável']['total'].sum() if not df_desp.empty else 0.0
+    custos_var_totais = cmv + comissoes + desp_var + custo_frete_real
+    margem_contrib = receita_bruta - custos_var_totais
+    lucro_liquido = margem_contrib - custo_fixo
+    margem_pct = (margem_contrib / receita_bruta) if receita_bruta > 0 else 0
+    ponto_equilibrio = (custo_fixo / margem_pct) if margem_pct > 0 else 0
+    meta_global = conn.execute("SELECT SUM(meta_mensal) FROM usuarios").fetchone()[0] or 100000.0
+    return {
+        "Receita": receita_bruta,
+        "(-) Custos Var.": custos_var_totais,
+        "(=) Margem Contrib.": margem_contrib,
+        "(-) Custos Fixos": custo_fixo,
+        "(=) Lucro Líquido": lucro_liquido,
+        "Ponto Equilíbrio": ponto_equilibrio,
+        "Meta Global": meta_global,
+        "Detalhe": {
+            "CMV": cmv,
+            "Comissões": comissoes,
+            "Desp. Var": desp_var,
+            "Frete Real": custo_frete_real
+        }
+    }
+
+def calcular_relatorio_parceiro(empresa, mes_ref):
+    am = ano_mes_int(mes_ref); alvo = mes_idx(am)
+    q = """SELECT c.nome as Nome, c.cpf as CPF, c.matricula as 'Matrícula', v.ano_mes, CAST(substr(v.data_venda, 9, 2) AS INTEGER) as dia, v.parcelas, v.valor_parcela, v.antecipada FROM vendas v JOIN clientes c ON v.cliente_id = c.id WHERE c.empresa = ?"""
+    df = pd.read_sql(q, conn, params=(empresa,)); ini = inicio_parcelas(df); ant = df['antecipada'] == 1
+    df['Valor'] = 0.0
+    df.loc[ant & (df['ano_mes'] == am), 'Valor'] = df['valor_parcela'] * df['parcelas']
+    df.loc[~ant & (ini <= alvo) & (alvo < ini + df['parcelas']), 'Valor'] = df['valor_parcela']
+    df = df[df['Valor'] > 0]
+    return df.groupby(['Nome','CPF','Matrícula'], as_index=False)['Valor'].sum(), float(df['Valor'].sum())
+
+def calcular_fluxo_caixa():
+    hj = datetime.now().date(); fluxo = []
+    meses = [hj + relativedelta(months=i) for i in range(6)]; ams = [m.year * 100 + m.month for m in meses]
+    df_v = pd.read_sql("SELECT ano_mes, CAST(substr(data_venda, 9, 2) AS INTEGER) as dia, parcelas, valor_parcela, antecipada FROM vendas", conn)
+    ini = inicio_parcelas(df_v); ant = df_v['antecipada'] == 1; total_ant = df_v['valor_parcela'] * df_v['parcelas']
+    desp = despesas_periodo(ams[0], ams[-1]).groupby('ano_mes')['total'].sum().to_dict()
+    for mes_ref, am in zip(meses, ams):
+        alvo = mes_idx(am); mes_nome = mes_ref.strftime("%b/%Y")
+        entradas = float(total_ant[ant & (df_v['ano_mes'] == am)].sum() + df_v.loc[~ant & (ini <= alvo) & (alvo < ini + df_v['parcelas']), 'valor_parcela'].sum())
+        saidas = desp.get(am) or 0.0
+        fluxo.append({"Mês": mes_nome, "Entradas": entradas, "Saídas": saidas, "Saldo": entradas - saidas})
+    return pd.DataFrame(fluxo)
+
+def baixar_backup():
+    # Backup online: em modo WAL o arquivo .db sozinho pode não ter as últimas escritas
+    tmp = f"backup_tmp_{os.getpid()}.db"
+    dst = sqlite3.connect(tmp); conn.backup(dst); dst.close()
+    with open(tmp, 'rb') as f: dados = f.read()
+    os.remove(tmp); return dados
+def image_to_base64(f): return base64.b64encode(f.getvalue()).decode('utf-8') if f else None
+def base64_to_image(b): return base64.b64decode(b) if b else None
+def get_calendario(ano, mes):
+    q = "SELECT v.ano_mes, CAST(substr(v.data_venda, 9, 2) AS INTEGER) as dia, v.parcelas, v.valor_parcela FROM vendas v WHERE v.antecipada = 0"
+    vendas = pd.read_sql(q, conn); ini = inicio_parcelas(vendas); alvo = mes_idx(ano * 100 + mes)
+    # Vencimentos caem sempre no dia 1 do mês
+    total = float(vendas.loc[(ini <= alvo) & (alvo < ini + vendas['parcelas']), 'valor_parcela'].sum())
+    return {1: total} if total else {}
+
+# PDF
+class PDF(FPDF):
+    def header(self):
+        try:
+            p = conn.execute("SELECT logo_path FROM config").fetchone()[0]
+            if p and os.path.exists(p): self.image(p, 10, 8, 40)
+        except: pass
+        self.set_font('Arial', 'B', 16); self.cell(0, 10, 'RECIBO E CONTRATO', 0, 1, 'C'); self.ln(15)
+def gerar_pdf(dados, tipo="recibo", texto_custom=None):
+    pdf = PDF(); pdf.add_page()
+    if tipo == "recibo":
+        doc_id = dados.get('cpf') if dados.get('cpf') else dados.get('cnpj', '')
+        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  1. IDENTIFICAÇÃO", 1, 1, 'L')
+        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 6, f"Nome/Razão Social: {dados['c']}\nCPF/CNPJ: {doc_id}\nEmpresa/Vínculo: {dados['e']}"); pdf.ln(5)
+        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  2. DETALHES", 1, 1, 'L')
+        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 6, f"Produto: {dados['p']}\nTotal: {format_brl(dados['v']+dados.get('frete',0))}\nParcelas: {dados['pa']}x de {format_brl(dados['vp'])}"); pdf.ln(5)
+        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  3. AUTORIZAÇÃO", 1, 1, 'L'); pdf.ln(2)
+        c = conn.cursor(); txt = texto_custom if texto_custom else c.execute("SELECT modelo_contrato FROM config").fetchone()[0]
+        final = txt.replace("{CLIENTE}", str(dados['c'])).replace("{VALOR}", f"{dados['v']:,.2f}").replace("{PRODUTO}", str(dados['p'])).replace("{PARCELAS}", str(dados['pa'])).replace("{EMPRESA_PARCEIRA}", str(dados['e'])).replace("{MATRICULA}", str(dados.get('m',''))).replace("{CPF}", str(doc_id))
+        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 5, final); pdf.ln(15)
+        pdf.line(20, pdf.get_y(), 190, pdf.get_y()); pdf.cell(0, 5, "Assinatura Cliente", 0, 1, 'C')
+    elif tipo == "rh":
+        pdf.set_font("Arial",'B',14); pdf.cell(0,10,f"Relatório de Descontos - {dados['empresa']}",0,1,'C')
+        pdf.set_font("Arial",'',12); pdf.cell(0,10,f"Referência: {dados['mes']}",0,1,'C'); pdf.ln(5)
+        pdf.set_font("Arial",'B',10)
+        pdf.cell(70,8,"Nome",1); pdf.cell(35,8,"CPF",1); pdf.cell(30,8,"Matrícula",1); pdf.cell(40,8,"Valor Desconto",1); pdf.ln()
+        pdf.set_font("Arial",'',10)
+        for _, r in dados['df'].iterrows():
+            pdf.cell(70,8,str(r['Nome'])[:35],1); pdf.cell(35,8,str(r['CPF']),1); pdf.cell(30,8,str(r['Matrícula']),1); pdf.cell(40,8,f"R$ {r['Valor']:.2f}",1); pdf.ln()
+        pdf.ln(5)
+        pdf.set_font("Arial",'B',12); pdf.cell(0,10,f"TOTAL GERAL: {format_brl(dados['total'])}",0,1,'R')
+    elif tipo == "geral":
+        pdf.set_font("Arial",'B',14); pdf.cell(0,10,f"Relatório Geral de Vendas",0,1,'C')
+        pdf.set_font("Arial",'',12); pdf.cell(0,10,f"{dados['periodo']}",0,1,'C'); pdf.ln(5)
+        pdf.set_font("Arial",'B',8)
+        pdf.cell(25,8,"Data",1); pdf.cell(50,8,"Cliente",1); pdf.cell(40,8,"Produto",1); pdf.cell(30,8,"Valor",1); pdf.cell(20,8,"Tipo",1); pdf.ln()
+        pdf.set_font("Arial",'',8)
+        for _, r in dados['df'].iterrows():
+            pdf.cell(25,8,str(r['data_venda']),1); pdf.cell(50,8,str(r['nome'])[:25],1); pdf.cell(40,8,str(r['produto_nome'])[:20],1)
+            pdf.cell(30,8,f"R$ {r['valor_venda']:.2f}",1); pdf.cell(20,8,"Antecipada" if r['antecipada'] else "Mensal",1); pdf.ln()
+        pdf.ln(5); pdf.set_font("Arial",'B',12); pdf.cell(0,10,f"TOTAL: {format_brl(dados['total'])}",0,1,'R')
+    elif tipo == "catalogo":
+        pdf.set_font("Arial", 'B', 16); pdf.cell(0, 10, "CATÁLOGO DE PRODUTOS", 0, 1, 'C'); pdf.ln(10)
+        df_prod = dados['df']
+        for i, r in df_prod.iterrows():
+            pdf.set_fill_color(248, 250, 252)
+            pdf.rect(10, pdf.get_y(), 190, 50, 'F')
+            if r['imagem']:
+                try:
+                    img_data = base64.b64decode(r['imagem'])
+                    temp_img = f"temp_img_{os.getpid()}_{i}.jpg"
+                    with open(temp_img, "wb") as f: f.write(img_data)
+                    pdf.image(temp_img, 15, pdf.get_y()+5, 40, 40)
+                    os.remove(temp_img)
+                except: pass
+            pdf.set_xy(60, pdf.get_y()+5)
+            pdf.set_font("Arial", 'B', 12); pdf.cell(0, 8, str(r['nome']), 0, 1)
+            pdf.set_x(60)
+            pdf.set_font("Arial", '', 10); pdf.cell(0, 6, f"Marca: {r['marca']}", 0, 1)
+            pdf.set_x(60)
+            pdf.set_font("Arial", 'B', 14); pdf.set_text_color(0, 100, 0)
+            pdf.cell(0, 10, f"{format_brl(r['valor_venda'])}", 0, 1)
+            pdf.set_text_color(0, 0, 0) 
+            pdf.ln(25); pdf.ln(5)
+    return pdf.output(dest='S').encode('latin-1')
+
+def importar_vendas(df_imp, ctx=None):
+    # Devolve (linhas importadas, linhas cujo produto não casou com o catálogo: venda gravada sem itens).
+    # 1ª passada só lê e valida (o progresso pode ser confirmado no jobs); a 2ª grava tudo numa única transação:
+    # erro ou cancelamento em qualquer linha não deixa importação parcial
+    mapa = mapa_produtos(); total = len(df_imp); sem_catalogo = []; linhas = []
+    clientes = dict(conn.execute("SELECT nome, id FROM clientes").fetchall())
+    for i, row in df_imp.iterrows():
+        try:
+            c_nome = str(row['Cliente']).strip(); d_venda = data_iso(row['Data (AAAA-MM-DD)'])
+            ant = 1 if str(row['Antecipada (S/N)']).upper() in ['S','SIM','1','TRUE'] else 0
+            vp = (float(row['Valor Venda']) + float(row['Frete Cobrado'])) / int(row['Parcelas'])
+            prods_imp = itens_por_nome(row['Produto'], mapa)
+            itens = ratear_itens(prods_imp, float(row['Custo Produto']), float(row['Valor Venda'])) if prods_imp else []
+        except (ValueError, TypeError, ZeroDivisionError) as e: raise ValueError(f"Linha {i + 2}: {e}")  # +2: cabeçalho e base 1 do CSV
+        if not prods_imp: sem_catalogo.append({'Linha': i + 2, 'Data': d_venda, 'Cliente': c_nome, 'Produto': row['Produto']})
+        linhas.append((c_nome, (d_venda, row['Vendedor'], row['Produto'], row['Custo Produto'], row['Valor Venda'], row['Frete Cobrado'], row['Custo Envio'], row['Parcelas'], vp, ant), itens))
+        if ctx and (i + 1) % 100 == 0: ctx.progresso(0.9 * (i + 1) / total, f"{i+1}/{total} linhas validadas")
+    if ctx: ctx.progresso(0.9, f"Gravando {total} vendas...")
+    try:
+        for c_nome, venda, itens in linhas:
+            if c_nome not in clientes: clientes[c_nome] = conn.execute("INSERT INTO clientes (nome, tipo) VALUES (?, 'PF')", (c_nome,)).lastrowid
+            d_venda, vend, prod, *resto = venda
+            cur = conn.execute("""INSERT INTO vendas (data_venda, vendedor, cliente_id, produto_nome, custo_produto, valor_venda, valor_frete, custo_envio, parcelas, valor_parcela, antecipada) VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                               (d_venda, vend, clientes[c_nome], prod, *resto))
+            if itens: registrar_itens_venda(cur.lastrowid, d_venda, itens)
+        conn.commit()
+    except Exception: conn.rollback(); raise
+    return total, pd.DataFrame(sem_catalogo, columns=['Linha', 'Data', 'Cliente', 'Produto'])
+
+# SNAPSHOT ANALÍTICO COLUNAR (v120)
+# Cópia em Arrow IPC de vendas/despesas, particionada por ano_mes e lida via memory-map:
+# Dashboard, DRE e ranking leem só as colunas/meses que precisam, sem disputar o lock das vendas.
+ANALYTICS_DIR = 'analytics_snapshot'; ANALYTICS_REFRESH_S = 60; ANALYTICS_MAX_ARQUIVOS = 20
+
+def _estado_snapshot():
+    try:
+        with open(os.path.join(ANALYTICS_DIR, '_estado.json')) as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+def _schema_snapshot(tabela, com_particao=False):
+    tipos = {'INTEGER': pa.int64(), 'REAL': pa.float64(), 'TEXT': pa.string()}
+    campos = [(col, tipos[t]) for col, t in SNAPSHOT_TABELAS[tabela]]
+    if com_particao and tabela in SNAPSHOT_PARTICIONADAS: campos.append(('ano_mes', pa.int32()))
+    return pa.schema(campos)
+
+def _gravar_arquivo_snapshot(pasta, nome, tabela, linhas):
+    # CAST no SELECT garante tipos estáveis entre arquivos; o temporário começa com '.' e o nome final é sempre novo
+    cols = SNAPSHOT_TABELAS[tabela]; schema = _schema_snapshot(tabela)
+    tbl = pa.table({col: pa.array([l[i] for l in linhas], type=schema.field(col).type) for i, (col, _) in enumerate(cols)}, schema=schema)
+    os.makedirs(pasta, exist_ok=True); destino = os.path.join(pasta, nome); tmp = os.path.join(pasta, f".{nome}.tmp")
+    with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, schema) as w: w.write_table(tbl)
+    os.replace(tmp, destino)
+    return os.path.relpath(destino, ANALYTICS_DIR)
+
+def _pasta_particao(tabela, am): return os.path.join(ANALYTICS_DIR, tabela, f"ano_mes={int(am or 0)}")
+
+def _publicar_estado(estado):
+    with open(os.path.join(ANALYTICS_DIR, '._estado.json.tmp'), 'w') as f: json.dump(estado, f)
+    os.replace(os.path.join(ANALYTICS_DIR, '._estado.json.tmp'), os.path.join(ANALYTICS_DIR, '_estado.json'))
+
+def remover_snapshot_clientes():
+    # clientes saiu do snapshot (nenhuma leitura analítica usa; era só cópia extra de CPF/CNPJ em disco). Migração: roda uma vez,
+    # não a cada rerun (um DELETE em toda abertura de página disputa o lock de escrita com as vendas)
+    for gatilho in ('upd', 'del'): conn.execute(f"DROP TRIGGER IF EXISTS trg_clientes_analytics_{gatilho}")
+    conn.execute("DELETE FROM analytics_pendencias WHERE tabela='clientes'")
+
+def atualizar_snapshot():
+    # Incremental: acrescenta linhas novas (id > marca d'água) e reescreve só os meses com UPDATE/DELETE pendente.
+    # Publicação por manifesto: _estado.json lista os arquivos vigentes de cada tabela e é trocado atomicamente; os leitores
+    # só abrem esses arquivos. O que sai da lista só é apagado na atualização seguinte, para não sumir sob um leitor em curso
+    if not (HAS_ARROW and HAS_FCNTL): return False
+    estado = _estado_snapshot(); geracao = time.time_ns()
+    for tabela in set(estado) - set(SNAPSHOT_TABELAS):  # tabela que saiu do snapshot (clientes): tira do manifesto e do disco
+        estado.pop(tabela); _publicar_estado(estado); shutil.rmtree(os.path.join(ANALYTICS_DIR, tabela), ignore_errors=True)
+    for tabela, cols in SNAPSHOT_TABELAS.items():
+        sel = ", ".join(f"CAST({c} AS {t}) AS {c}" for c, t in cols); part = tabela in SNAPSHOT_PARTICIONADAS
+        sel_am = (sel + ", COALESCE(ano_mes, 0)") if part else (sel + ", 0")
+        atual = estado.get(tabela, {}); marca = atual.get('ultimo_id'); arquivos = list(atual.get('arquivos', [])); descartados = []
+        nova_marca = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {tabela}").fetchone()[0]
+        max_pend = conn.execute("SELECT COALESCE(MAX(id), 0) FROM analytics_pendencias WHERE tabela=?", (tabela,)).fetchone()[0]
+        meses = {r[0] for r in conn.execute("SELECT DISTINCT ano_mes FROM analytics_pendencias WHERE tabela=? AND id<=?", (tabela, max_pend))}
+        base = os.path.join(ANALYTICS_DIR, tabela)
+        for a in atual.get('descartados', []):
+            if os.path.exists(os.path.join(ANALYTICS_DIR, a)): os.remove(os.path.join(ANALYTICS_DIR, a))
+        if marca is None or 'arquivos' not in atual or not all(os.path.exists(os.path.join(ANALYTICS_DIR, a)) for a in arquivos) or (meses and not part):
+            # Carga completa (1ª vez, manifesto ausente/incompleto, ou tabela não particionada com alteração): tudo que já
+            # estava na pasta vira descarte, inclusive arquivos órfãos de versões antigas
+            descartados = [os.path.relpath(os.path.join(d, a), ANALYTICS_DIR) for d, _, nomes in os.walk(base) for a in nomes]
+            grupos = {}
+            for l in conn.execute(f"SELECT {sel_am} FROM {tabela} WHERE id<=?", (nova_marca,)).fetchall(): grupos.setdefault(l[-1], []).append(l[:-1])
+            arquivos = [_gravar_arquivo_snapshot(_pasta_particao(tabela, am) if part else base, f"full-{geracao}.arrow", tabela, ls) for am, ls in grupos.items()]
+        else:
+            if part:
+                # Compacta partições fragmentadas junto com as alteradas
+                por_mes = {}
+                for a in arquivos: por_mes.setdefault(os.path.dirname(a), []).append(a)
+                meses |= {int(d.split('=')[1]) for d, arqs in por_mes.items() if len(arqs) > ANALYTICS_MAX_ARQUIVOS}
+                for am in meses:
+                    linhas = conn.execute(f"SELECT {sel} FROM {tabela} WHERE COALESCE(ano_mes, 0)=? AND id<=?", (am, nova_marca)).fetchall()
+                    velhos = por_mes.get(os.path.relpath(_pasta_particao(tabela, am), ANALYTICS_DIR), [])
+                    descartados += velhos; arquivos = [a for a in arquivos if a not in velhos]
+                    if linhas: arquivos.append(_gravar_arquivo_snapshot(_pasta_particao(tabela, am), f"full-{geracao}.arrow", tabela, linhas))
+            if nova_marca > marca:
+                grupos = {}
+                for l in conn.execute(f"SELECT {sel_am} FROM {tabela} WHERE id>? AND id<=?", (marca, nova_marca)).fetchall():
+                    if not (part and l[-1] in meses): grupos.setdefault(l[-1], []).append(l[:-1])
+                arquivos += [_gravar_arquivo_snapshot(_pasta_particao(tabela, am) if part else base, f"part-{geracao}.arrow", tabela, ls) for am, ls in grupos.items()]
+        estado[tabela] = {'ultimo_id': nova_marca, 'atualizado_em': data_iso(datetime.now(), com_hora=True), 'arquivos': arquivos, 'descartados': descartados}
+        _publicar_estado(estado)
+        # Só depois de publicado: se cair antes, as pendências são refeitas na próxima rodada
+        conn.execute("DELETE FROM analytics_pendencias WHERE tabela=? AND id<=?", (tabela, max_pend)); conn.commit()
+    return True
+
+def atualizar_snapshot_periodico():
+    # Chamado pelos workers ociosos; flock garante um único atualizador entre processos
+    if not (HAS_ARROW and HAS_FCNTL): return
+    atualizado = min((v.get('atualizado_em', '') for v in _estado_snapshot().values()), default='')
+    if atualizado and (datetime.now() - datetime.fromisoformat(atualizado)).total_seconds() < ANALYTICS_REFRESH_S: return
+    os.makedirs(ANALYTICS_DIR, exist_ok=True)
+    with open(os.path.join(ANALYTICS_DIR, '.lock'), 'w') as trava:
+        try: fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: return
+        try: atualizar_snapshot()
+        except Exception: conn.rollback()
+
+def ler_analitico(tabela, colunas, filtro, sql_fallback, params=()):
+    # filtro: função que recebe ds.field e monta o predicado (empurrado para partições/arquivos)
+    # Só os arquivos do manifesto publicado são lidos (nada de descoberta na pasta, onde pode haver arquivo em gravação)
+    arquivos = _estado_snapshot().get(tabela, {}).get('arquivos') if HAS_ARROW and HAS_FCNTL else None
+    if arquivos is not None:
+        try:
+            dset = ds.dataset([os.path.join(ANALYTICS_DIR, a) for a in arquivos], format='ipc', schema=_schema_snapshot(tabela, True), filesystem=pafs.LocalFileSystem(use_mmap=True),
+                              partitioning=ds.partitioning(pa.schema([('ano_mes', pa.int32())]), flavor='hive') if tabela in SNAPSHOT_PARTICIONADAS else None,
+                              partition_base_dir=os.path.join(ANALYTICS_DIR, tabela))
+            return dset.to_table(columns=colunas, filter=filtro(ds.field) if filtro else None).to_pandas()
+        except (OSError, pa.ArrowException): pass  # arquivo descartado sob o leitor: cai para o banco
+    return pd.read_sql(sql_fallback, conn, params=params)
+
+def frescor_analitico():
+    estado = _estado_snapshot() if HAS_ARROW and HAS_FCNTL else {}
+    if not estado: return "🕒 Dados analíticos: consulta direta ao banco (snapshot ainda não gerado)."
+    atualizado = datetime.fromisoformat(min(v['atualizado_em'] for v in estado.values()))
+    seg = int((datetime.now() - atualizado).total_seconds())
+    return f"🕒 Dados analíticos de {atualizado.strftime('%d/%m %H:%M:%S')} (há {seg // 60} min {seg % 60} s; atualização a cada {ANALYTICS_REFRESH_S}s)."
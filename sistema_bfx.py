@@ -1,19 +1,25 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
-from fpdf import FPDF
 import os
 import math
 import time
-import base64
 import urllib.parse
 import re
 import io
 import requests
 import calendar
 import json
+import gzip
+import csv
+import bisect
+import threading
+import unicodedata
+from bfx_nucleo import (conn, init_db, data_iso, ano_mes_int, clean_str, format_brl, ratear_itens, registrar_itens_venda, calcular_ranking_produtos, encerrar_regra, versionar_regra,
+                        check_credito, calcular_dre_avancado, calcular_fluxo_caixa, gerar_pdf, image_to_base64, base64_to_image, ler_analitico, frescor_analitico)
+from bfx_jobs import JOBS_DIR, JOBS_EM_PROCESSO, JOBS_BACKUPS_MANTIDOS, JOBS_RETENCAO_DIAS, executar_job, iniciar_workers, limpar_artefatos
 
 # Tenta importar OpenAI
 try:
@@ -55,54 +61,7 @@ st.markdown("""
 # ==============================================================================
 # 2. BANCO DE DADOS
 # ==============================================================================
-@st.cache_resource
-def get_connection(): return sqlite3.connect('bfx_sistema.db', check_same_thread=False)
-conn = get_connection()
-
-def init_db():
-    c = conn.cursor()
-    tables = [
-        '''CREATE TABLE IF NOT EXISTS clientes (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, renda REAL, empresa TEXT, matricula TEXT, telefone TEXT, cpf TEXT, cnpj TEXT, tipo TEXT, data_nascimento DATE, cep TEXT, endereco TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS produtos (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, custo_padrao REAL, marca TEXT, categoria TEXT, ncm TEXT, imagem TEXT, fornecedor_id INTEGER, qtd_estoque INTEGER DEFAULT 0, valor_venda REAL DEFAULT 0)''',
-        '''CREATE TABLE IF NOT EXISTS vendas (id INTEGER PRIMARY KEY AUTOINCREMENT, data_venda DATE, vendedor TEXT, cliente_id INTEGER, produto_nome TEXT, custo_produto REAL, valor_venda REAL, valor_frete REAL DEFAULT 0, custo_envio REAL DEFAULT 0, parcelas INTEGER, valor_parcela REAL, taxa_financeira_valor REAL, lucro_liquido REAL, antecipada INTEGER DEFAULT 1, excedeu_limite INTEGER DEFAULT 0, comprovante_pdf TEXT, FOREIGN KEY(cliente_id) REFERENCES clientes(id))''',
-        '''CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY AUTOINCREMENT, modelo_contrato TEXT, logo_path TEXT, openai_key TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT, role TEXT, nome_exibicao TEXT, email TEXT, telefone TEXT, data_nascimento DATE, endereco TEXT, cep TEXT, meta_mensal REAL DEFAULT 50000.0, comissao_pct REAL DEFAULT 2.0)''',
-        '''CREATE TABLE IF NOT EXISTS fornecedores (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, telefone TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS empresas_parceiras (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT UNIQUE, responsavel_rh TEXT, telefone_rh TEXT, email_rh TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS pagamentos (id INTEGER PRIMARY KEY AUTOINCREMENT, data_pagamento DATE, vendedor TEXT, valor REAL, obs TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS audit_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, data_hora DATETIME, usuario TEXT, acao TEXT, detalhes TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS despesas (id INTEGER PRIMARY KEY AUTOINCREMENT, data_despesa DATE, descricao TEXT, categoria TEXT, valor REAL, tipo TEXT)''',
-        '''CREATE TABLE IF NOT EXISTS avisos (id INTEGER PRIMARY KEY AUTOINCREMENT, data_criacao DATETIME, mensagem TEXT, ativo INTEGER DEFAULT 1)'''
-    ]
-    for sql in tables: c.execute(sql)
-
-    def force_add_column(table, col, dtype):
-        try:
-            existing_cols = [i[1] for i in c.execute(f"PRAGMA table_info({table})")]
-            if col not in existing_cols: c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {dtype}")
-        except: pass
-
-    force_add_column('clientes', 'cnpj', 'TEXT')
-    force_add_column('clientes', 'tipo', 'TEXT')
-    force_add_column('produtos', 'valor_venda', 'REAL DEFAULT 0')
-    force_add_column('vendas', 'comprovante_pdf', 'TEXT')
-    force_add_column('config', 'openai_key', 'TEXT')
-
-    try:
-        c.execute("UPDATE usuarios SET password = '123' WHERE username = 'bruno'")
-        if c.execute("SELECT count(*) FROM usuarios WHERE username='bruno'").fetchone()[0] == 0:
-             c.execute("INSERT INTO usuarios (username, password, role, nome_exibicao) VALUES ('bruno', '123', 'vendedor', 'Bruno')")
-    except: pass
-
-    if c.execute("SELECT count(*) FROM usuarios WHERE username='admin'").fetchone()[0] == 0:
-        c.execute("INSERT INTO usuarios (username, password, role, nome_exibicao) VALUES ('admin', 'admin', 'admin', 'Administrador')")
-    
-    for emp in ["Amazon Five", "Gimam"]:
-        if c.execute("SELECT count(*) FROM empresas_parceiras WHERE nome=?", (emp,)).fetchone()[0] == 0:
-            c.execute("INSERT INTO empresas_parceiras (nome, responsavel_rh, telefone_rh, email_rh) VALUES (?,?,?,?)", (emp, "RH "+emp, "", ""))
-    if c.execute("SELECT COUNT(*) FROM config").fetchone()[0] == 0:
-        c.execute("INSERT INTO config (modelo_contrato, logo_path) VALUES (?, ?)", ("Texto Padrão...", ""))
-    conn.commit()
+# Banco, regras de negócio, PDF e snapshot analítico ficam em bfx_nucleo.py (sem Streamlit, usado também pelos workers)
 init_db()
 
 # ==============================================================================
@@ -119,194 +78,235 @@ def mask_tel(val):
     return val
 def mask_cep(val):
     v = re.sub(r'\D', '', str(val)); return f"{v[:5]}-{v[5:]}" if len(v) == 8 else val
-def clean_str(val): return re.sub(r'\D', '', str(val)) if val else ""
-def format_brl(v): return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if v else "R$ 0,00"
 def gerar_link_zap(tel, msg): return f"https://wa.me/{clean_str(tel)}?text={urllib.parse.quote(msg)}" if tel else None
 
+# CLASSIFICAÇÃO NCM (v122)
+# Tabela NCM vigente (~10 mil códigos) carregada uma vez por processo: índice invertido por termo para a busca
+# na descrição oficial + trie de apelidos (padrão e aprendidos ao salvar produtos) com casamento mais longo.
+NCM_TABELA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ncm_tabela.csv.gz')
+NCM_CACHE_MAX = 5000  # sugestões memorizadas (nomes digitados em todas as sessões)
+NCM_APELIDOS_PADRAO = {"celular": "8517.13.00", "iphone": "8517.13.00", "smartphone": "8517.13.00", "carregador": "8504.40.10", "cabo": "8544.42.00", "fone": "8518.30.00", "airpods": "8518.30.00",
+                       "headset": "8518.30.00", "tv": "8528.72.00", "televisor": "8528.72.00", "notebook": "8471.30.12", "macbook": "8471.30.12", "tablet": "8471.30.11", "ipad": "8471.30.11",
+                       "capa": "3926.90.90", "case": "3926.90.90", "pelicula": "3919.90.90", "smartwatch": "8517.62.77", "apple watch": "8517.62.77", "alexa": "8518.22.00", "caixa de som": "8518.22.00",
+                       "power bank": "8507.60.00", "cartao de memoria": "8523.51.10", "pendrive": "8523.51.10", "mouse": "8471.60.53", "teclado": "8471.60.52",
+                       "roteador": "8517.62.77", "ar condicionado": "8415.10.11", "split": "8415.10.11", "moto": "8517.13.00", "galaxy": "8517.13.00", "redmi": "8517.13.00",
+                       "base carregadora": "8504.40.10", "console": "9504.50.00", "playstation": "9504.50.00", "ps5": "9504.50.00", "xbox": "9504.50.00", "nintendo switch": "9504.50.00",
+                       "fogao": "7321.11.00", "geladeira": "8418.10.00", "ventilador": "8414.51.90", "secador": "8516.31.00", "escova secadora": "8516.31.00", "liquidificador": "8509.40.10",
+                       "cafeteira": "8516.71.00", "churrasqueira eletrica": "8516.60.00", "perfume": "3303.00.10", "body splash": "3303.00.20", "bodysplash": "3303.00.20", "mochila": "4202.92.00",
+                       "tenis": "6404.11.00", "air fryer": "8516.60.00", "fritadeira": "8516.60.00"}
+NCM_STOPWORDS = {'de', 'da', 'do', 'das', 'dos', 'e', 'ou', 'a', 'o', 'as', 'os', 'para', 'com', 'sem', 'em', 'no', 'na', 'nos', 'nas', 'por', 'um', 'uma', 'mesmo', 'mesma',
+                 'outro', 'outra', 'incluindo', 'exceto', 'seu', 'sua', 'tal', 'como', 'ao', 'aos', 'pela', 'pelo', 'que', 'se', 'nao', 'posicao', 'exemplo'}
+NCM_UNIDADES = {'x', 'un', 'und', 'unid', 'unidade', 'pc', 'kit', 'cx', 'kg', 'g', 'mg', 'ml', 'l', 'lt', 'litro', 'cm', 'mm', 'm', 'metro', 'gb', 'tb', 'mah', 'w', 'v', 'pol', 'polegada'}
+
+def normalizar_termos(texto):
+    # minúsculas, sem acento, plural simples -> singular ("carregadores" -> "carregador", "cartões" -> "cartao")
+    t = unicodedata.normalize('NFKD', str(texto or '').lower()); termos = []
+    for tk in re.findall(r'[a-z0-9]+', ''.join(ch for ch in t if not unicodedata.combining(ch))):
+        if len(tk) > 4 and tk.endswith('oes'): tk = tk[:-3] + 'ao'
+        elif len(tk) > 4 and tk.endswith('es') and tk[-3] in 'rzl': tk = tk[:-2]
+        elif len(tk) > 3 and tk.endswith('s'): tk = tk[:-1]
+        if tk not in NCM_STOPWORDS: termos.append(tk)
+    return termos
+
+def formatar_ncm(valor):
+    d = clean_str(valor); return f"{d[:4]}.{d[4:6]}.{d[6:]}" if len(d) == 8 else None
+
+class ClassificadorNCM:
+    def __init__(self, caminho):
+        self.descricoes, self.curtas, self.rotulos, self.folha, self.contexto, self.tam_folha, self.nucleos = {}, {}, {}, {}, {}, {}, {}
+        with gzip.open(caminho, 'rt', encoding='utf-8') as f:
+            for cod, desc in csv.reader(f, delimiter=';'):
+                if cod == 'codigo': continue
+                partes = re.split(r' -+ ', desc); curta = partes[-1]; folha = set(normalizar_termos(curta))
+                self.descricoes[cod] = desc; self.curtas[cod] = curta; self.rotulos[cod] = " › ".join(partes[-2:]); self.tam_folha[cod] = len(folha)
+                self.nucleos[cod] = {ts[0] for ts in map(normalizar_termos, partes) if ts}  # 1º termo de cada nível: "Bicicletas e outros ciclos" -> bicicleta
+                for t in folha: self.folha.setdefault(t, []).append(cod)
+                for t in set(normalizar_termos(desc)) - folha: self.contexto.setdefault(t, []).append(cod)
+        n = len(self.descricoes)
+        self.idf = {t: math.log(n / (len(self.folha.get(t, ())) + len(self.contexto.get(t, ())))) + 0.1 for t in set(self.folha) | set(self.contexto)}
+        self.vocab = sorted(self.idf); self.trie = {}; self.trava = threading.Lock(); self.cache = {}
+        for termo, cod in NCM_APELIDOS_PADRAO.items(): self._inserir(termo, cod, 'padrão')
+
+    def _inserir(self, termo, cod, origem):
+        no = self.trie
+        for t in normalizar_termos(termo): no = no.setdefault(t, {})
+        if no is not self.trie: no['$'] = (cod, origem)
+
+    def carregar_apelidos(self):
+        for termo, cod in conn.execute("SELECT termo, ncm FROM ncm_apelidos"): self._inserir(termo, cod, 'aprendido')
+
+    def aprender(self, termo, cod):
+        with self.trava: self._inserir(termo, cod, 'aprendido'); self.cache.clear()
+
+    def _apelidos(self, termos):
+        # Casamento mais longo em cada posição; ordena por tamanho da frase, depois pela 1ª posição (núcleo do nome:
+        # "Capa para iPhone" é capa) e por fim aprendido antes de padrão
+        achados = []
+        for i in range(len(termos)):
+            no, melhor = self.trie, None
+            for j in range(i, len(termos)):
+                no = no.get(termos[j])
+                if no is None: break
+                if '$' in no: melhor = (j - i + 1, no['$'])
+            if melhor: achados.append((-melhor[0], i, melhor[1][1] != 'aprendido', melhor[1]))
+        return [a[3] for a in sorted(achados)]
+
+    def _tabela(self, termos):
+        pontos, cobertos, nucleo = {}, {}, {}
+        principal = next((t for t in termos if t.isalpha() and t not in NCM_UNIDADES), None)  # "2x cabo usb", "500 ml garrafa": pula quantidade/unidade
+        for t in dict.fromkeys(termos):
+            if t.isdigit() or len(t) < 2: continue
+            i = bisect.bisect_left(self.vocab, t)  # prefixo: só as 20 entradas seguintes do vocabulário ordenado
+            variantes = [(t, 1.0)] if t in self.idf else [(v, 0.7) for v in self.vocab[i:i + 20] if v.startswith(t)] if len(t) >= 4 else []
+            melhor = {}
+            for v, fator in variantes:
+                w = self.idf[v] * fator
+                for cod in self.folha.get(v, ()): melhor[cod] = max(melhor.get(cod, 0), w)
+                for cod in self.contexto.get(v, ()): melhor[cod] = max(melhor.get(cod, 0), w * 0.35)
+            for cod, w in melhor.items(): pontos[cod] = pontos.get(cod, 0) + w; cobertos[cod] = cobertos.get(cod, 0) + 1
+            if t == principal:
+                for v, _ in variantes:
+                    for cod in self.contexto.get(v, ()): nucleo[cod] = max(nucleo.get(cod, 0), 3 if v in self.nucleos[cod] else 1)
+                    for cod in self.folha.get(v, ()): nucleo[cod] = max(nucleo.get(cod, 0), 3 if v in self.nucleos[cod] else 2)
+        # Núcleo do nome (1º termo alfabético, como em _apelidos): abrindo um nível da descrição > na folha > no contexto > ausente
+        # ("Bicicleta aro 29" é bicicleta, não pneu "do tipo utilizado em bicicletas"); depois mais termos casados
+        # e, por fim, específico > genérico: folhas curtas pontuam mais e itens "Outros/Outras" perdem no empate
+        return sorted(pontos, key=lambda c: (-nucleo.get(c, 0), -cobertos[c], -pontos[c] / (1 + 0.03 * self.tam_folha[c]) * (0.85 if self.curtas[c].lower().startswith('outr') else 1), c))
+
+    def sugerir(self, nome, k=5):
+        # Cache compartilhado entre sessões e limitado (descarta o mais antigo); aprender() pode limpá-lo a qualquer momento
+        chave = (nome, k); res = self.cache.get(chave)
+        if res is not None: return res
+        termos = normalizar_termos(nome); res = []
+        for cod, origem in self._apelidos(termos) + [(c, 'tabela') for c in self._tabela(termos)[:k * 2]]:
+            if cod not in {r['ncm'] for r in res}: res.append({'ncm': cod, 'descricao': self.rotulos.get(cod, ''), 'origem': origem})
+            if len(res) >= k: break
+        with self.trava:
+            if len(self.cache) >= NCM_CACHE_MAX: self.cache.pop(next(iter(self.cache)))
+            self.cache[chave] = res
+        return res
+
+@st.cache_resource
+def classificador_ncm():
+    cls = ClassificadorNCM(NCM_TABELA); cls.carregar_apelidos(); return cls
+
 def sugerir_ncm(nome_prod):
-    if not nome_prod: return ""
-    nome = nome_prod.lower()
-    ncms = {"celular":"8517.12.31","iphone":"8517.12.31","smartphone":"8517.12.31","carregador":"8504.40.10","cabo":"8544.42.00","fone":"8518.30.00","airpods":"8518.30.00","tv":"8528.72.00","televisor":"8528.72.00","notebook":"8471.30.12","macbook":"8471.30.12","tablet":"8471.30.11","ipad":"8471.30.11","capa":"3926.90.90","pelicula":"3919.90.00","smartwatch":"8517.62.77","apple watch":"8517.62.77","alexa":"8518.22.00"}
-    for k, v in ncms.items():
-        if k in nome: return v
-    return ""
-
-def check_credito(cli_id, parc_nova):
-    res = pd.read_sql(f"SELECT renda FROM clientes WHERE id={cli_id}", conn)
-    if res.empty: return True, 0, 0, 0
-    teto = min(res.iloc[0]['renda']*0.30, 475.00)
-    vendas = pd.read_sql(f"SELECT data_venda, parcelas, valor_parcela FROM vendas WHERE cliente_id={cli_id}", conn)
-    tomado = 0.0; hj = datetime.now().date()
-    for _, r in vendas.iterrows():
-        try:
-            dv = pd.to_datetime(r['data_venda']).date()
-            ini = dv.replace(day=1) + relativedelta(months=1 if dv.day <= 20 else 2)
-            fim = ini + relativedelta(months=int(r['parcelas']))
-            if ini <= hj.replace(day=1) < fim: tomado += r['valor_parcela']
-        except: continue
-    return (tomado+parc_nova) <= (teto+1.0), teto-tomado, tomado, teto
-
-def calcular_dre_avancado(mes_ano):
-    q_rec = f"SELECT SUM(valor_venda + valor_frete) as total FROM vendas WHERE strftime('%Y-%m', data_venda)='{mes_ano}'"
-    receita_bruta = pd.read_sql(q_rec, conn).iloc[0]['total'] or 0.0
-    q_cmv = f"SELECT SUM(custo_produto) as total FROM vendas WHERE strftime('%Y-%m', data_venda)='{mes_ano}'"
-    cmv = pd.read_sql(q_cmv, conn).iloc[0]['total'] or 0.0
-    q_frete_custo = f"SELECT SUM(custo_envio) as total FROM vendas WHERE strftime('%Y-%m', data_venda)='{mes_ano}'"
-    custo_frete_real = pd.read_sql(q_frete_custo, conn).iloc[0]['total'] or 0.0
-    q_vends = f"SELECT vendedor, SUM(valor_venda+valor_frete) as total FROM vendas WHERE strftime('%Y-%m', data_venda)='{mes_ano}' GROUP BY vendedor"
-    df_vends = pd.read_sql(q_vends, conn); comissoes = 0.0
-    for _, r in df_vends.iterrows():
-        pct = conn.execute("SELECT comissao_pct FROM usuarios WHERE nome_exibicao=?", (r['vendedor'],)).fetchone()
-        comissoes += r['total'] * ((pct[0] if pct else 2.0) / 100.0)
-    q_desp = f"SELECT tipo, SUM(valor) as total FROM despesas WHERE strftime('%Y-%m', data_despesa)='{mes_ano}' GROUP BY tipo"
-    df_desp = pd.read_sql(q_desp, conn)
-    custo_fixo = df_desp[df_desp['tipo']=='Fixa']['total'].sum() if not df_desp.empty else 0.0
-    desp_var = df_desp[df_desp['tipo']=='Variável']['total'].sum() if not df_desp.empty else 0.0
-    custos_var_totais = cmv + comissoes + desp_var + custo_frete_real
-    margem_contrib = receita_bruta - custos_var_totais
-    lucro_liquido = margem_contrib - custo_fixo
-    margem_pct = (margem_contrib / receita_bruta) if receita_bruta > 0 else 0
-    ponto_equilibrio = (custo_fixo / margem_pct) if margem_pct > 0 else 0
-    meta_global = conn.execute("SELECT SUM(meta_mensal) FROM usuarios").fetchone()[0] or 100000.0
-    return {
-        "Receita": receita_bruta,
-        "(-) Custos Var.": custos_var_totais,
-        "(=) Margem Contrib.": margem_contrib,
-        "(-) Custos Fixos": custo_fixo,
-        "(=) Lucro Líquido": lucro_liquido,
-        "Ponto Equilíbrio": ponto_equilibrio,
-        "Meta Global": meta_global,
-        "Detalhe": {
-            "CMV": cmv,
-            "Comissões": comissoes,
-            "Desp. Var": desp_var,
-            "Frete Real": custo_frete_real
-        }
-    }
-
-def calcular_relatorio_parceiro(empresa, mes_ref):
-    mes_str = mes_ref 
-    q = f"""SELECT c.nome, c.cpf, c.matricula, v.data_venda, v.parcelas, v.valor_parcela, v.antecipada FROM vendas v JOIN clientes c ON v.cliente_id = c.id WHERE c.empresa = '{empresa}'"""
-    df = pd.read_sql(q, conn)
-    lista_descontos = []; total_geral = 0.0
-    for _, r in df.iterrows():
-        try:
-            dv = datetime.strptime(r['data_venda'], '%Y-%m-%d').date()
-            if r['antecipada'] == 1:
-                if dv.strftime("%Y-%m") == mes_str:
-                    val = r['valor_parcela'] * r['parcelas']
-                    lista_descontos.append({'Nome': r['nome'], 'CPF': r['cpf'], 'Matrícula': r['matricula'], 'Valor': val}); total_geral += val
-            else:
-                ini = dv + relativedelta(months=1 if dv.day <= 20 else 2)
-                for p in range(int(r['parcelas'])):
-                    venc = ini + relativedelta(months=p)
-                    if venc.strftime("%Y-%m") == mes_str:
-                        lista_descontos.append({'Nome': r['nome'], 'CPF': r['cpf'], 'Matrícula': r['matricula'], 'Valor': r['valor_parcela']}); total_geral += r['valor_parcela']
-        except: continue
-    return pd.DataFrame(lista_descontos).groupby(['Nome','CPF','Matrícula'], as_index=False).sum(), total_geral
-
-def calcular_fluxo_caixa():
-    hj = datetime.now().date(); fluxo = []
-    for i in range(6):
-        mes_ref = hj + relativedelta(months=i); mes_str = mes_ref.strftime("%Y-%m"); mes_nome = mes_ref.strftime("%b/%Y")
-        q_vendas = "SELECT data_venda, parcelas, valor_parcela, antecipada FROM vendas"
-        df_v = pd.read_sql(q_vendas, conn); entradas = 0.0
-        for _, r in df_v.iterrows():
-            if r['antecipada'] == 1:
-                if r['data_venda'].startswith(mes_str): entradas += (r['valor_parcela'] * r['parcelas'])
-            else:
-                dv = datetime.strptime(r['data_venda'], '%Y-%m-%d').date()
-                venc_base = dv + relativedelta(months=1 if dv.day <= 20 else 2)
-                for p in range(int(r['parcelas'])):
-                    venc = venc_base + relativedelta(months=p)
-                    if venc.strftime("%Y-%m") == mes_str: entradas += r['valor_parcela']
-        q_desp = f"SELECT SUM(valor) FROM despesas WHERE strftime('%Y-%m', data_despesa)='{mes_str}'"
-        saidas = conn.execute(q_desp).fetchone()[0] or 0.0
-        fluxo.append({"Mês": mes_nome, "Entradas": entradas, "Saídas": saidas, "Saldo": entradas - saidas})
-    return pd.DataFrame(fluxo)
-
-def baixar_backup():
-    with open('bfx_sistema.db', 'rb') as f: return f.read()
-def image_to_base64(f): return base64.b64encode(f.getvalue()).decode('utf-8') if f else None
-def base64_to_image(b): return base64.b64decode(b) if b else None
-def get_calendario(ano, mes):
-    q = "SELECT v.data_venda, v.parcelas, v.valor_parcela FROM vendas v WHERE v.antecipada = 0"
-    vendas = pd.read_sql(q, conn); dados = {}
-    for _, r in vendas.iterrows():
-        try:
-            dv = datetime.strptime(r['data_venda'], '%Y-%m-%d').date()
-            ini = dv.replace(day=1) + relativedelta(months=1 if dv.day <= 20 else 2)
-            for p in range(int(r['parcelas'])):
-                venc = ini + relativedelta(months=p)
-                if venc.year == ano and venc.month == mes: dados[venc.day] = dados.get(venc.day, 0) + r['valor_parcela']
-        except: continue
-    return dados
-
-# PDF
-class PDF(FPDF):
-    def header(self):
-        try:
-            p = conn.execute("SELECT logo_path FROM config").fetchone()[0]
-            if p and os.path.exists(p): self.image(p, 10, 8, 40)
-        except: pass
-        self.set_font('Arial', 'B', 16); self.cell(0, 10, 'RECIBO E CONTRATO', 0, 1, 'C'); self.ln(15)
-def gerar_pdf(dados, tipo="recibo", texto_custom=None):
-    pdf = PDF(); pdf.add_page()
-    if tipo == "recibo":
-        doc_id = dados.get('cpf') if dados.get('cpf') else dados.get('cnpj', '')
-        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  1. IDENTIFICAÇÃO", 1, 1, 'L')
-        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 6, f"Nome/Razão Social: {dados['c']}\nCPF/CNPJ: {doc_id}\nEmpresa/Vínculo: {dados['e']}"); pdf.ln(5)
-        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  2. DETALHES", 1, 1, 'L')
-        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 6, f"Produto: {dados['p']}\nTotal: {format_brl(dados['v']+dados.get('frete',0))}\nParcelas: {dados['pa']}x de {format_brl(dados['vp'])}"); pdf.ln(5)
-        pdf.set_font("Arial", 'B', 11); pdf.cell(0, 8, "  3. AUTORIZAÇÃO", 1, 1, 'L'); pdf.ln(2)
-        c = conn.cursor(); txt = texto_custom if texto_custom else c.execute("SELECT modelo_contrato FROM config").fetchone()[0]
-        final = txt.replace("{CLIENTE}", str(dados['c'])).replace("{VALOR}", f"{dados['v']:,.2f}").replace("{PRODUTO}", str(dados['p'])).replace("{PARCELAS}", str(dados['pa'])).replace("{EMPRESA_PARCEIRA}", str(dados['e'])).replace("{MATRICULA}", str(dados.get('m',''))).replace("{CPF}", str(doc_id))
-        pdf.set_font("Arial", '', 10); pdf.multi_cell(0, 5, final); pdf.ln(15)
-        pdf.line(20, pdf.get_y(), 190, pdf.get_y()); pdf.cell(0, 5, "Assinatura Cliente", 0, 1, 'C')
-    elif tipo == "rh":
-        pdf.set_font("Arial",'B',14); pdf.cell(0,10,f"Relatório de Descontos - {dados['empresa']}",0,1,'C')
-        pdf.set_font("Arial",'',12); pdf.cell(0,10,f"Referência: {dados['mes']}",0,1,'C'); pdf.ln(5)
-        pdf.set_font("Arial",'B',10)
-        pdf.cell(70,8,"Nome",1); pdf.cell(35,8,"CPF",1); pdf.cell(30,8,"Matrícula",1); pdf.cell(40,8,"Valor Desconto",1); pdf.ln()
-        pdf.set_font("Arial",'',10)
-        for _, r in dados['df'].iterrows():
-            pdf.cell(70,8,str(r['Nome'])[:35],1); pdf.cell(35,8,str(r['CPF']),1); pdf.cell(30,8,str(r['Matrícula']),1); pdf.cell(40,8,f"R$ {r['Valor']:.2f}",1); pdf.ln()
-        pdf.ln(5)
-        pdf.set_font("Arial",'B',12); pdf.cell(0,10,f"TOTAL GERAL: {format_brl(dados['total'])}",0,1,'R')
-    elif tipo == "geral":
-        pdf.set_font("Arial",'B',14); pdf.cell(0,10,f"Relatório Geral de Vendas",0,1,'C')
-        pdf.set_font("Arial",'',12); pdf.cell(0,10,f"{dados['periodo']}",0,1,'C'); pdf.ln(5)
-        pdf.set_font("Arial",'B',8)
-        pdf.cell(25,8,"Data",1); pdf.cell(50,8,"Cliente",1); pdf.cell(40,8,"Produto",1); pdf.cell(30,8,"Valor",1); pdf.cell(20,8,"Tipo",1); pdf.ln()
-        pdf.set_font("Arial",'',8)
-        for _, r in dados['df'].iterrows():
-            pdf.cell(25,8,str(r['data_venda']),1); pdf.cell(50,8,str(r['nome'])[:25],1); pdf.cell(40,8,str(r['produto_nome'])[:20],1)
-            pdf.cell(30,8,f"R$ {r['valor_venda']:.2f}",1); pdf.cell(20,8,"Antecipada" if r['antecipada'] else "Mensal",1); pdf.ln()
-        pdf.ln(5); pdf.set_font("Arial",'B',12); pdf.cell(0,10,f"TOTAL: {format_brl(dados['total'])}",0,1,'R')
-    elif tipo == "catalogo":
-        pdf.set_font("Arial", 'B', 16); pdf.cell(0, 10, "CATÁLOGO DE PRODUTOS", 0, 1, 'C'); pdf.ln(10)
-        df_prod = dados['df']
-        for i, r in df_prod.iterrows():
-            pdf.set_fill_color(248, 250, 252)
-            pdf.rect(10, pdf.get_y(), 190, 50, 'F')
-            if r['imagem']:
-                try:
-                    img_data = base64.b64decode(r['imagem'])
-                    temp_img = f"temp_img_{i}.jpg"
-                    with open(temp_img, "wb") as f: f.write(img_data)
-                    pdf.image(temp_img, 15, pdf.get_y()+5, 40, 40)
-                    os.remove(temp_img)
-                except: pass
-            pdf.set_xy(60, pdf.get_y()+5)
-            pdf.set_font("Arial", 'B', 12); pdf.cell(0, 8, str(r['nome']), 0, 1)
-            pdf.set_x(60)
-            pdf.set_font("Arial", '', 10); pdf.cell(0, 6, f"Marca: {r['marca']}", 0, 1)
-            pdf.set_x(60)
-            pdf.set_font("Arial", 'B', 14); pdf.set_text_color(0, 100, 0)
-            pdf.cell(0, 10, f"{format_brl(r['valor_venda'])}", 0, 1)
-            pdf.set_text_color(0, 0, 0) 
-            pdf.ln(25); pdf.ln(5)
-    return pdf.output(dest='S').encode('latin-1')
+    sug = classificador_ncm().sugerir(nome_prod, 1) if nome_prod else []
+    return sug[0]['ncm'] if sug else ""
+
+def aprender_ncm(nome_prod, ncm):
+    # Nome do produto vira apelido do NCM escolhido pelo usuário (vale para próximos cadastros e reclassificações)
+    termo = " ".join(normalizar_termos(nome_prod)); cod = formatar_ncm(ncm)
+    if not termo or not cod: return
+    conn.execute("INSERT INTO ncm_apelidos (termo, ncm, atualizado_em) VALUES (?,?,?) ON CONFLICT(termo) DO UPDATE SET ncm=excluded.ncm, usos=usos+1, atualizado_em=excluded.atualizado_em",
+                 (termo, cod, data_iso(datetime.now(), com_hora=True))); conn.commit()
+    classificador_ncm().aprender(termo, cod)
+
+def reclassificar_produtos(df):
+    # Prévia da reclassificação em massa: marca para aplicar quando o NCM atual está vazio/inexistente e a sugestão vem de apelido; casamentos só pela tabela ficam para revisão
+    cls = classificador_ncm(); sugs = [(cls.sugerir(n, 1) or [{}])[0] for n in df['nome']]
+    df = df.assign(ncm_sugerido=[s.get('ncm', '') for s in sugs], descricao=[s.get('descricao', '') for s in sugs], origem=[s.get('origem', '') for s in sugs])
+    return df.assign(Aplicar=[bool(s) and o != 'tabela' and a != s and formatar_ncm(a) not in cls.descricoes for a, s, o in zip(df['ncm'].fillna(''), df['ncm_sugerido'], df['origem'])])
+
+# JOBS EM SEGUNDO PLANO (v118): fila e workers em bfx_jobs.py; aqui só o enfileiramento e o painel
+def enfileirar_job(tipo, params=None):
+    cur = conn.execute("INSERT INTO jobs (tipo, params, usuario, criado_em) VALUES (?,?,?,?)", (tipo, json.dumps(params or {}), st.session_state.get('nome_exibicao', 'Sistema'), data_iso(datetime.now(), com_hora=True)))
+    conn.commit()
+    if not JOBS_EM_PROCESSO:
+        conn.execute("UPDATE jobs SET status='executando', worker_pid=?, iniciado_em=? WHERE id=?", (os.getpid(), data_iso(datetime.now(), com_hora=True), cur.lastrowid)); conn.commit()
+        executar_job(cur.lastrowid, tipo, json.dumps(params or {}))
+        limpar_artefatos()  # sem supervisor, a retenção de jobs_artefatos/ roda aqui
+    return cur.lastrowid
+iniciar_workers()
+
+def ler_artefato(caminho):
+    with open(caminho, 'rb') as f: return f.read()
+
+def painel_job(job_id):
+    # Só job pendente/executando fica no fragmento com polling; finalizado é desenhado uma vez, e o artefato
+    # só é lido quando o usuário clica em baixar (um backup .db não é reenviado ao navegador a cada 2 s)
+    job = conn.execute("SELECT tipo, status, progresso, mensagem, resultado_path FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if not job: return
+    if job[1] in ('pendente', 'executando'): painel_job_ativo(job_id); return
+    tipo, status, prog, msg, caminho = job
+    st.progress(prog or 0.0, text=f"Job #{job_id} ({tipo}): {status}" + (f" - {msg}" if msg else ""))
+    if status == 'erro': st.error(f"Erro: {msg}")
+    elif status == 'concluido' and caminho and os.path.exists(caminho):
+        if caminho.endswith('.pkl'):
+            df_res = pd.read_pickle(caminho); st.dataframe(df_res, use_container_width=True, hide_index=True)
+            st.download_button("📥 Baixar CSV", data=lambda: df_res.to_csv(index=False).encode('utf-8'), file_name=os.path.basename(caminho).replace('.pkl', '.csv'), mime="text/csv", key=f"dl_job_{job_id}")
+        else:
+            st.download_button("📥 Baixar Resultado", data=lambda: ler_artefato(caminho), file_name=os.path.basename(caminho), mime="application/pdf" if caminho.endswith('.pdf') else "application/octet-stream", key=f"dl_job_{job_id}")
+
+@st.fragment(run_every=2)
+def painel_job_ativo(job_id):
+    # Widget de acompanhamento: só este fragmento reroda enquanto o job trabalha; ao terminar, um rerun da página troca pelo resultado
+    tipo, status, prog, msg = conn.execute("SELECT tipo, status, progresso, mensagem FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if status not in ('pendente', 'executando'): st.rerun()
+    st.progress(prog or 0.0, text=f"Job #{job_id} ({tipo}): {status}" + (f" - {msg}" if msg else ""))
+    if st.button("⛔ Cancelar", key=f"canc_job_{job_id}"):
+        conn.execute("UPDATE jobs SET cancelar=1, status=CASE WHEN status='pendente' THEN 'cancelado' ELSE status END WHERE id=?", (job_id,)); conn.commit()
+
+# GRADES EDITÁVEIS: CHANGE-SET + CONCORRÊNCIA OTIMISTA (v119)
+class ConflitoEdicao(Exception): pass
+
+def valor_sql(v):
+    # numpy/pandas -> tipos nativos do sqlite3; NaN/NaT -> NULL; datas -> ISO
+    if v is None or (not isinstance(v, str) and pd.isna(v)): return None
+    if isinstance(v, (date, datetime)): return data_iso(v)
+    return v.item() if hasattr(v, 'item') else v
+
+def carregar_grade(nome, sql, params=(), datas=()):
+    # Snapshot guardado na sessão: recarrega enquanto não há edição pendente e fica congelado durante a edição
+    chave = f"grade_{nome}"; versao = st.session_state.get(chave + "_v", 0); editor_key = f"{chave}_editor_{versao}"
+    estado = st.session_state.get(editor_key) or {}
+    if chave not in st.session_state or not any(estado.get(k) for k in ('edited_rows', 'added_rows', 'deleted_rows')):
+        df = pd.read_sql(sql, conn, params=params)
+        for col in datas: df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
+        st.session_state[chave] = df
+    return st.session_state[chave], editor_key
+
+def descartar_grade(nome):
+    st.session_state.pop(f"grade_{nome}", None); st.session_state[f"grade_{nome}_v"] = st.session_state.get(f"grade_{nome}_v", 0) + 1
+
+def calcular_changeset(snapshot, estado, colunas, conversores=None, chave='id'):
+    # Usa o estado do st.data_editor (só as linhas mexidas): custo proporcional às alterações, não ao tamanho da grade
+    conv = lambda c, v: valor_sql(conversores[c](v) if conversores and c in conversores and valor_sql(v) is not None else v)
+    removidas = set(int(p) for p in estado.get('deleted_rows', []))
+    antes = lambda pos: [valor_sql(snapshot.iloc[pos][c]) for c in colunas]
+    inseridos = [[conv(c, linha.get(c)) for c in colunas] for linha in estado.get('added_rows', []) if any(valor_sql(linha.get(c)) not in (None, '') for c in colunas)]
+    atualizados = []
+    for pos, mudancas in estado.get('edited_rows', {}).items():
+        pos = int(pos)
+        if pos in removidas: continue
+        orig = antes(pos); novo = [conv(c, mudancas[c]) if c in mudancas else v for c, v in zip(colunas, orig)]
+        if novo != orig: atualizados.append((int(snapshot.iloc[pos][chave]), novo, orig))
+    removidos = [(int(snapshot.iloc[pos][chave]), antes(pos)) for pos in sorted(removidas)]
+    return {'inseridos': inseridos, 'atualizados': atualizados, 'removidos': removidos}
+
+def aplicar_changeset(tabela, cs, colunas, chave='id'):
+    # Uma transação, um executemany por operação; UPDATE/DELETE só valem se a linha ainda está como no snapshot
+    conds = " AND ".join(f"{c} IS ?" for c in colunas)
+    try:
+        if cs['atualizados']:
+            cur = conn.executemany(f"UPDATE {tabela} SET {', '.join(f'{c}=?' for c in colunas)} WHERE {chave}=? AND {conds}", [(*novo, rid, *orig) for rid, novo, orig in cs['atualizados']])
+            if cur.rowcount != len(cs['atualizados']): raise ConflitoEdicao(f"{len(cs['atualizados']) - cur.rowcount} registro(s) foram alterados por outro usuário.")
+        if cs['removidos']:
+            cur = conn.executemany(f"DELETE FROM {tabela} WHERE {chave}=? AND {conds}", [(rid, *orig) for rid, orig in cs['removidos']])
+            if cur.rowcount != len(cs['removidos']): raise ConflitoEdicao(f"{len(cs['removidos']) - cur.rowcount} registro(s) foram alterados por outro usuário.")
+        if cs['inseridos']:
+            conn.executemany(f"INSERT INTO {tabela} ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})", cs['inseridos'])
+        conn.commit()
+    except Exception: conn.rollback(); raise
+    return len(cs['inseridos']), len(cs['atualizados']), len(cs['removidos'])
+
+def salvar_grade(nome, tabela, colunas, estado, conversores=None):
+    try:
+        ins, upd, rem = aplicar_changeset(tabela, calcular_changeset(st.session_state[f"grade_{nome}"], estado or {}, colunas, conversores), colunas)
+    except ConflitoEdicao as e:
+        descartar_grade(nome); st.error(f"⚠️ {e} Nada foi salvo; a tabela foi recarregada com os dados atuais."); return False
+    except (ValueError, sqlite3.Error) as e: st.error(f"Erro ao salvar: {e}"); return False
+    descartar_grade(nome); st.toast(f"Salvo: {ins} nova(s), {upd} alterada(s), {rem} removida(s)."); return True
 
 # ==============================================================================
 # 4. LOGIN E SESSÃO
@@ -315,7 +315,7 @@ if 'logged_in' not in st.session_state:
     st.session_state.update({'logged_in':False, 'username':None, 'role':None, 'nome_exibicao':None, 'user_id':None})
 
 def registrar_log(acao, detalhes):
-    try: conn.execute("INSERT INTO audit_logs (data_hora, usuario, acao, detalhes) VALUES (?,?,?,?)", (datetime.now(), st.session_state.get('nome_exibicao','Sistema'), acao, detalhes)); conn.commit()
+    try: conn.execute("INSERT INTO audit_logs (data_hora, usuario, acao, detalhes) VALUES (?,?,?,?)", (data_iso(datetime.now(), com_hora=True), st.session_state.get('nome_exibicao','Sistema'), acao, detalhes)); conn.commit()
     except: pass
 
 def login_screen():
@@ -351,11 +351,13 @@ with st.sidebar:
     st.write(f"Olá, **{nome_user}**")
     if st.button("Sair"): st.session_state['logged_in'] = False; st.rerun()
     st.markdown("---")
-    if role == 'admin': menu = st.radio("Menu", ["Dashboard", "💰 Financeiro & DRE", "🏦 Prudent (Antecipação)", "🤖 BFX Intelligence (IA)", "📥 Importação", "Venda Rápida", "Histórico (Editar)", "Cadastros", "👥 Gestão de RH (Equipe)", "🖨️ Relatórios", "Configurações"])
+    if role == 'admin': menu = st.radio("Menu", ["Dashboard", "💰 Financeiro & DRE", "🏦 Prudent (Antecipação)", "🤖 BFX Intelligence (IA)", "📥 Importação", "Venda Rápida", "Histórico (Editar)", "Cadastros", "👥 Gestão de RH (Equipe)", "🖨️ Relatórios", "⏳ Jobs", "Configurações"])
     else: menu = st.radio("Menu", ["Venda Rápida", "Minhas Comissões", "Histórico (Editar)", "Cadastros", "Relatórios PDF", "Meu Perfil"])
     st.markdown("---")
     hj = datetime.now().date(); ini_mes = hj.replace(day=1)
-    df_pod = pd.read_sql(f"SELECT vendedor, SUM(valor_venda+valor_frete) as total FROM vendas WHERE data_venda >= '{ini_mes}' GROUP BY vendedor ORDER BY total DESC", conn)
+    df_pod = ler_analitico('vendas', ['vendedor', 'valor_venda', 'valor_frete'], lambda f: (f('ano_mes') >= ini_mes.year * 100 + ini_mes.month) & (f('dia_ord') >= ini_mes.toordinal()),
+                           "SELECT vendedor, valor_venda, valor_frete FROM vendas WHERE dia_ord >= ?", (ini_mes.toordinal(),))
+    df_pod = (df_pod['valor_venda'] + df_pod['valor_frete']).groupby(df_pod['vendedor'], dropna=False).sum(min_count=1).rename('total').reset_index().sort_values('total', ascending=False, na_position='last').reset_index(drop=True)
     if not df_pod.empty:
         html_p = "<div class='podio-box'><h5>🏆 Ranking Mês</h5>"
         for i, row in df_pod.head(5).iterrows():
@@ -386,7 +388,7 @@ def run_ai_chat(prompt):
 # ==============================================================================
 
 if menu == "Dashboard" and role == 'admin':
-    st.subheader("📊 Dashboard Executivo & Performance")
+    st.subheader("📊 Dashboard Executivo & Performance"); st.caption(frescor_analitico())
     
     # 1. FILTROS GERAIS
     with st.expander("🔍 Filtros do Dashboard", expanded=True):
@@ -397,28 +399,28 @@ if menu == "Dashboard" and role == 'admin':
         sel_vend = c3.multiselect("Vendedores", vendedores, default=vendedores)
     
     if not sel_vend: sel_vend = vendedores
-    vends_str = "', '".join(sel_vend)
+    vends_ph = ",".join("?" * len(sel_vend))
     
-    # Query Principal (Filtrada)
+    # Query Principal (Filtrada) - poda por partição ano_mes + dia_ord no snapshot (fallback: idx_vendas_dia_ord)
+    cols_dash = ['data_venda', 'vendedor', 'valor_venda', 'lucro_liquido', 'produto_nome', 'id']
     q_dash = f"""
     SELECT v.data_venda, v.vendedor, v.valor_venda, v.lucro_liquido, v.produto_nome, v.id
     FROM vendas v 
-    WHERE v.data_venda BETWEEN '{d_ini}' AND '{d_fim}'
-    AND v.vendedor IN ('{vends_str}')
+    WHERE v.dia_ord BETWEEN ? AND ?
+    AND v.vendedor IN ({vends_ph})
     """
     
     # Query Evolução (Últimos 6 Meses - Independente do filtro)
-    date_6m = (datetime.now() - relativedelta(months=5)).replace(day=1).strftime("%Y-%m-%d")
-    q_evo = f"""
-    SELECT strftime('%Y-%m', data_venda) as mes, SUM(valor_venda) as total, SUM(lucro_liquido) as lucro
-    FROM vendas 
-    WHERE data_venda >= '{date_6m}'
-    GROUP BY mes ORDER BY mes
-    """
+    dt_6m = datetime.now() - relativedelta(months=5); am_6m = dt_6m.year * 100 + dt_6m.month
+    q_evo = "SELECT ano_mes, valor_venda, lucro_liquido FROM vendas WHERE ano_mes >= ?"
     
     try: 
-        df_dash = pd.read_sql(q_dash, conn)
-        df_evo = pd.read_sql(q_evo, conn)
+        df_dash = ler_analitico('vendas', cols_dash, lambda f: (f('ano_mes') >= d_ini.year * 100 + d_ini.month) & (f('ano_mes') <= d_fim.year * 100 + d_fim.month) &
+                                (f('dia_ord') >= d_ini.toordinal()) & (f('dia_ord') <= d_fim.toordinal()) & f('vendedor').isin(sel_vend),
+                                q_dash, [d_ini.toordinal(), d_fim.toordinal()] + sel_vend).sort_values('id').reset_index(drop=True)
+        df_evo = ler_analitico('vendas', ['ano_mes', 'valor_venda', 'lucro_liquido'], lambda f: f('ano_mes') >= am_6m, q_evo, (am_6m,))
+        df_evo = df_evo.groupby('ano_mes').agg(total=('valor_venda', 'sum'), lucro=('lucro_liquido', 'sum')).reset_index().sort_values('ano_mes')
+        df_evo.insert(0, 'mes', df_evo['ano_mes'].map(lambda a: f"{int(a) // 100:04d}-{int(a) % 100:02d}")); df_evo = df_evo.drop(columns='ano_mes')
     except: 
         df_dash = pd.DataFrame()
         df_evo = pd.DataFrame()
@@ -465,8 +467,9 @@ if menu == "Dashboard" and role == 'admin':
             
         with c_rank:
             st.markdown("##### 📦 Top 5 Produtos (Vol.)")
-            top_prod = df_dash['produto_nome'].value_counts().head(5)
-            st.bar_chart(top_prod, horizontal=True)
+            df_top = calcular_ranking_produtos(d_ini, d_fim, sel_vend).head(5)
+            if not df_top.empty: st.bar_chart(df_top.set_index('produto')['qtd'], horizontal=True)
+            else: st.info("Sem itens de venda no período.")
 
         st.markdown("---")
         st.markdown("##### 📊 Raio-X da Equipe (Performance Detalhada)")
@@ -535,7 +538,7 @@ elif menu == "💰 Financeiro & DRE" and role == 'admin':
     st.subheader("💰 Gestão Financeira Completa"); t1, t2, t3 = st.tabs(["DRE Inteligente", "Fluxo de Caixa", "Lançamentos"])
     with t1:
         mes = st.selectbox("Competência", [(datetime.now()-relativedelta(months=i)).strftime("%Y-%m") for i in range(12)])
-        dre = calcular_dre_avancado(mes)
+        dre = calcular_dre_avancado(mes); st.caption(frescor_analitico())
         k1, k2, k3 = st.columns(3)
         k1.markdown(f"<div class='fin-card'><div class='fin-label'>Receita Bruta</div><div class='fin-value'>{format_brl(dre['Receita'])}</div></div>", unsafe_allow_html=True)
         # Proteção contra erros de cálculo (v103)
@@ -547,71 +550,110 @@ elif menu == "💰 Financeiro & DRE" and role == 'admin':
         cor = "fin-good" if dre['(=) Lucro Líquido'] >= 0 else "fin-bad"
         k3.markdown(f"<div class='fin-card'><div class='fin-label'>Lucro Líquido</div><div class='fin-value {cor}'>{format_brl(dre['(=) Lucro Líquido'])}</div></div>", unsafe_allow_html=True)
         st.divider(); st.text(f"(-) CMV: {format_brl(dre['Detalhe']['CMV'])}\n(-) Comissões: {format_brl(dre['Detalhe']['Comissões'])}\n(-) Frete Real: {format_brl(dre['Detalhe']['Frete Real'])}\n(-) Despesas Fixas: {format_brl(dre['(-) Custos Fixos'])}")
+        if st.button("⏳ DRE dos últimos 12 meses (segundo plano)"): st.session_state['job_dre'] = enfileirar_job('dre_periodo', {'meses': 12})
+        if st.session_state.get('job_dre'): painel_job(st.session_state['job_dre'])
     with t2:
         df_fluxo = calcular_fluxo_caixa()
         st.bar_chart(df_fluxo.set_index("Mês")[["Entradas", "Saídas"]], color=["#10b981", "#ef4444"])
         st.dataframe(df_fluxo.style.format({'Entradas': 'R$ {:.2f}', 'Saídas': 'R$ {:.2f}', 'Saldo': 'R$ {:.2f}'}), use_container_width=True)
+        if st.button("⏳ Exportar Fluxo de Caixa (segundo plano)"): st.session_state['job_fluxo'] = enfileirar_job('fluxo_caixa')
+        if st.session_state.get('job_fluxo'): painel_job(st.session_state['job_fluxo'])
     with t3:
         # NOVO: FORMULÁRIO DE ADIÇÃO (v104)
         with st.form("d"):
             dc = st.text_input("Descrição"); vl = st.number_input("Valor", value=None, placeholder="0.00")
             tp = st.selectbox("Tipo", ["Fixa", "Variável"]); dt = st.date_input("Vencimento")
             is_rec = st.checkbox("🔄 Despesa Recorrente? (Repetir mensalmente)")
-            qtd_rec = st.number_input("Repetir por quantos meses?", min_value=2, value=12) if is_rec else 1
+            qtd_rec = st.number_input("Repetir por quantos meses? (0 = sem término)", min_value=0, value=12)
             if st.form_submit_button("Lançar Despesa"):
-                if is_rec:
-                    for i in range(qtd_rec):
-                        new_date = dt + relativedelta(months=i)
-                        new_desc = f"{dc} ({i+1}/{qtd_rec})"
-                        conn.execute("INSERT INTO despesas (data_despesa, descricao, valor, tipo) VALUES (?,?,?,?)", (new_date, new_desc, vl or 0.0, tp))
-                else: conn.execute("INSERT INTO despesas (data_despesa, descricao, valor, tipo) VALUES (?,?,?,?)", (dt, dc, vl or 0.0, tp))
+                # Recorrência vira uma regra única, expandida só nos meses consultados (v117)
+                if is_rec: conn.execute("INSERT INTO despesas_recorrentes (descricao, valor, tipo, data_inicio, intervalo_meses, qtd_ocorrencias) VALUES (?,?,?,?,1,?)", (dc, vl or 0.0, tp, data_iso(dt), qtd_rec or None))
+                else: conn.execute("INSERT INTO despesas (data_despesa, descricao, valor, tipo) VALUES (?,?,?,?)", (data_iso(dt), dc, vl or 0.0, tp))
                 conn.commit(); st.success("Lançado!"); st.rerun()
         
         st.divider()
         st.markdown("##### ✏️ Gerenciar Despesas Existentes")
-        # NOVO: EDIÇÃO E EXCLUSÃO (v105)
-        df_desp = pd.read_sql("SELECT id, data_despesa, descricao, categoria, valor, tipo FROM despesas ORDER BY data_despesa DESC", conn)
-        evt_desp = st.dataframe(df_desp, selection_mode="single-row", on_select="rerun", use_container_width=True, hide_index=True)
-        
-        if evt_desp.selection.rows:
-            sel_idx = evt_desp.selection.rows[0]
-            d_id = df_desp.iloc[sel_idx]['id']
-            row = df_desp.iloc[sel_idx]
-            
-            with st.form(f"edit_d_{d_id}"):
-                st.info(f"Editando: {row['descricao']}")
-                c1, c2 = st.columns(2)
-                ndt = c1.date_input("Data", datetime.strptime(row['data_despesa'], '%Y-%m-%d'))
-                ndc = c2.text_input("Descrição", row['descricao'])
-                nvl = c1.number_input("Valor", value=float(row['valor']))
-                ntp = c2.selectbox("Tipo", ["Fixa", "Variável"], index=0 if row['tipo']=="Fixa" else 1)
-                
-                c_btn1, c_btn2 = st.columns(2)
-                if c_btn1.form_submit_button("💾 Salvar Alterações"):
-                    conn.execute("UPDATE despesas SET data_despesa=?, descricao=?, valor=?, tipo=? WHERE id=?", (ndt, ndc, nvl, ntp, int(d_id)))
-                    conn.commit(); st.success("Atualizado!"); time.sleep(1); st.rerun()
-                
-                if c_btn2.form_submit_button("🗑️ EXCLUIR DESPESA", type="primary"):
-                    conn.execute("DELETE FROM despesas WHERE id=?", (int(d_id),))
-                    conn.commit(); st.warning("Apagado."); time.sleep(1); st.rerun()
+        # Edição em grade: só as linhas alteradas vão para o banco (v119)
+        df_desp, k_desp = carregar_grade("despesas", "SELECT id, data_despesa, descricao, categoria, valor, tipo FROM despesas ORDER BY data_despesa DESC", datas=['data_despesa'])
+        st.data_editor(df_desp, key=k_desp, num_rows="dynamic", use_container_width=True, hide_index=True,
+                       column_config={"id": st.column_config.NumberColumn(disabled=True), "data_despesa": st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+                                      "valor": st.column_config.NumberColumn("Valor", format="R$ %.2f"), "tipo": st.column_config.SelectboxColumn("Tipo", options=["Fixa", "Variável"])})
+        if st.button("💾 SALVAR DESPESAS"):
+            if salvar_grade("despesas", "despesas", ["data_despesa", "descricao", "categoria", "valor", "tipo"], st.session_state.get(k_desp), {"data_despesa": data_iso}): st.rerun()
+
+        st.divider()
+        st.markdown("##### 🔄 Despesas Recorrentes (Regras)")
+        df_reg = pd.read_sql("SELECT id, descricao, COALESCE(valor, 0) AS valor, tipo, data_inicio, intervalo_meses, COALESCE(qtd_ocorrencias, 0) AS qtd_ocorrencias, data_fim FROM despesas_recorrentes WHERE ativo=1 ORDER BY descricao", conn)
+        if df_reg.empty: st.caption("Nenhuma regra de recorrência cadastrada.")
+        else:
+            evt_reg = st.dataframe(df_reg, selection_mode="single-row", on_select="rerun", use_container_width=True, hide_index=True)
+            if evt_reg.selection.rows:
+                reg = df_reg.iloc[evt_reg.selection.rows[0]]; r_id = int(reg['id'])
+                with st.form(f"edit_r_{r_id}"):
+                    st.info(f"Editando regra: {reg['descricao']}")
+                    c1, c2 = st.columns(2)
+                    rdc = c1.text_input("Descrição", reg['descricao']); rvl = c2.number_input("Valor", value=float(reg['valor']))
+                    rtp = c1.selectbox("Tipo", ["Fixa", "Variável"], index=0 if reg['tipo']=="Fixa" else 1)
+                    rqtd = c2.number_input("Nº de ocorrências (0 = sem término)", min_value=0, value=int(reg['qtd_ocorrencias']))
+                    # Meses anteriores já fechados não mudam: alteração/encerramento vale do mês escolhido em diante
+                    rdesde = c1.text_input("Alterar/encerrar a partir de (AAAA-MM)", datetime.now().strftime("%Y-%m"))
+                    st.caption("Exceção para um único mês (opcional):")
+                    e1, e2, e3 = st.columns(3)
+                    emes = e1.text_input("Mês (AAAA-MM)"); evl = e2.number_input("Valor no mês", value=None, placeholder="0.00"); ecanc = e3.checkbox("Cancelar ocorrência")
+                    c_btn1, c_btn2 = st.columns(2)
+                    if c_btn1.form_submit_button("💾 Salvar Regra"):
+                        try:
+                            am_desde = ano_mes_int(data_iso(rdesde.strip() + "-01")); vigente = r_id
+                            if (rdc, rvl, rtp, rqtd or None) != (reg['descricao'], float(reg['valor']), reg['tipo'], int(reg['qtd_ocorrencias']) or None):
+                                vigente = versionar_regra(r_id, am_desde, rdc, rvl, rtp, rqtd or None)
+                            if emes:
+                                am_exc = ano_mes_int(data_iso(emes.strip() + "-01"))
+                                conn.execute("INSERT INTO despesas_recorrentes_excecoes (regra_id, ano_mes, valor, cancelada) VALUES (?,?,?,?) ON CONFLICT(regra_id, ano_mes) DO UPDATE SET valor=excluded.valor, cancelada=excluded.cancelada",
+                                             (vigente if vigente and am_exc >= am_desde else r_id, am_exc, evl, 1 if ecanc else 0))
+                            conn.commit(); st.success("Regra atualizada!"); st.rerun()
+                        except ValueError: conn.rollback(); st.error("Mês inválido. Use o formato AAAA-MM.")
+                    if c_btn2.form_submit_button("⛔ ENCERRAR REGRA", type="primary"):
+                        try:
+                            encerrar_regra(r_id, ano_mes_int(data_iso(rdesde.strip() + "-01"))); conn.commit()
+                            st.warning(f"Regra encerrada a partir de {rdesde.strip()}; meses anteriores foram mantidos."); st.rerun()
+                        except ValueError: conn.rollback(); st.error("Mês inválido. Use o formato AAAA-MM.")
 
 elif menu == "🏦 Prudent (Antecipação)" and role == 'admin':
     st.subheader("🏦 Central de Antecipação de Recebíveis")
-    q_pend = """SELECT id, data_venda, produto_nome, valor_venda, parcelas, valor_parcela FROM vendas WHERE antecipada = 0"""
-    df_pend = pd.read_sql(q_pend, conn)
+    q_pend = """SELECT id, data_venda, produto_nome, valor_venda, parcelas, valor_parcela, antecipada FROM vendas WHERE antecipada = 0"""
+    df_pend, k_pend = carregar_grade("antecipacao", q_pend)
     if not df_pend.empty:
-        df_pend['Selecionar'] = False
-        edited_df = st.data_editor(df_pend, column_config={"Selecionar": st.column_config.CheckboxColumn(required=True)}, hide_index=True, use_container_width=True)
+        cols_pend = ["Selecionar", "id", "data_venda", "produto_nome", "valor_venda", "parcelas", "valor_parcela"]
+        edited_df = st.data_editor(df_pend.assign(Selecionar=False), key=k_pend, column_config={"Selecionar": st.column_config.CheckboxColumn(required=True)}, column_order=cols_pend, disabled=cols_pend[1:], hide_index=True, use_container_width=True)
         sel_rows = edited_df[edited_df['Selecionar'] == True]
         total_ant = sel_rows['valor_venda'].sum()
         st.divider(); c1, c2 = st.columns(2); c1.metric("Total Selecionado", format_brl(total_ant))
         if c2.button("💰 ANTECIPAR SELECIONADOS", type="primary"):
-            ids = sel_rows['id'].tolist()
-            if ids:
-                conn.execute(f"UPDATE vendas SET antecipada=1 WHERE id IN ({','.join(map(str, ids))})"); conn.commit()
-                st.success(f"{len(ids)} vendas antecipadas com sucesso!"); time.sleep(1); st.rerun()
+            marcadas = {pos: {'antecipada': 1} for pos, m in ((st.session_state.get(k_pend) or {}).get('edited_rows') or {}).items() if m.get('Selecionar')}
+            if marcadas and salvar_grade("antecipacao", "vendas", ["antecipada"], {'edited_rows': marcadas}): st.rerun()
     else: st.success("🎉 Nenhuma venda pendente de antecipação.")
 
+elif menu == "⏳ Jobs" and role == 'admin':
+    st.subheader("⏳ Fila de Jobs (Segundo Plano)")
+    for mig, quando, erro in conn.execute("SELECT nome, data_hora, erro FROM migracoes WHERE erro IS NOT NULL"):
+        st.error(f"Migração '{mig}' falhou em {quando} e não será repetida automaticamente: {erro}")
+    with st.expander("➕ Enfileirar Relatório"):
+        with st.form("nj"):
+            tp_job = st.selectbox("Tipo", ["Relatório RH (Empresa Parceira)", "Backup do Banco", "Snapshot Analítico (Atualizar Agora)"])
+            c1, c2 = st.columns(2)
+            emp_job = c1.selectbox("Empresa", pd.read_sql("SELECT nome FROM empresas_parceiras ORDER BY nome", conn)['nome'].tolist())
+            mes_job = c2.selectbox("Referência", [(datetime.now()+relativedelta(months=i)).strftime("%Y-%m") for i in range(-6, 3)], index=6)
+            if st.form_submit_button("Enfileirar"):
+                if tp_job.startswith("Relatório"): st.session_state['job_admin'] = enfileirar_job('relatorio_rh', {'empresa': emp_job, 'mes': mes_job})
+                elif tp_job.startswith("Snapshot"): st.session_state['job_admin'] = enfileirar_job('snapshot_analitico')
+                else: st.session_state['job_admin'] = enfileirar_job('backup')
+    st.caption(f"Jobs finalizados e seus arquivos ficam {JOBS_RETENCAO_DIAS} dias; de backup do banco, só os {JOBS_BACKUPS_MANTIDOS} mais recentes.")
+    df_jobs = pd.read_sql("SELECT id, tipo, status, progresso, mensagem, usuario, criado_em, finalizado_em FROM jobs ORDER BY id DESC LIMIT 200", conn)
+    evt_job = st.dataframe(df_jobs, selection_mode="single-row", on_select="rerun", use_container_width=True, hide_index=True,
+                           column_config={"progresso": st.column_config.ProgressColumn("Progresso", min_value=0, max_value=1)})
+    if evt_job.selection.rows: painel_job(int(df_jobs.iloc[evt_job.selection.rows[0]]['id']))
+    elif st.session_state.get('job_admin'): painel_job(st.session_state['job_admin'])
+
 elif menu == "📥 Importação" and role == 'admin':
     st.subheader("📥 Importação de Vendas em Massa")
     def gerar_modelo_importacao():
@@ -623,21 +665,12 @@ elif menu == "📥 Importação" and role == 'admin':
         try:
             df_imp = pd.read_csv(up_file)
             if st.button(f"Processar {len(df_imp)} Linhas"):
-                prog = st.progress(0); sucesso = 0
-                for i, row in df_imp.iterrows():
-                    c_nome = str(row['Cliente']).strip()
-                    c_id = conn.execute("SELECT id FROM clientes WHERE nome=?", (c_nome,)).fetchone()
-                    if not c_id:
-                        conn.execute("INSERT INTO clientes (nome, tipo) VALUES (?, 'PF')", (c_nome,))
-                        c_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                    else: c_id = c_id[0]
-                    ant = 1 if str(row['Antecipada (S/N)']).upper() in ['S','SIM','1','TRUE'] else 0
-                    vp = (float(row['Valor Venda']) + float(row['Frete Cobrado'])) / int(row['Parcelas'])
-                    conn.execute("""INSERT INTO vendas (data_venda, vendedor, cliente_id, produto_nome, custo_produto, valor_venda, valor_frete, custo_envio, parcelas, valor_parcela, antecipada) VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-                        (row['Data (AAAA-MM-DD)'], row['Vendedor'], c_id, row['Produto'], row['Custo Produto'], row['Valor Venda'], row['Frete Cobrado'], row['Custo Envio'], row['Parcelas'], vp, ant))
-                    prog.progress((i + 1) / len(df_imp)); sucesso += 1
-                conn.commit(); st.success("Importação concluída!"); time.sleep(2); st.rerun()
+                # Importação roda em segundo plano; a tela (e as vendas) seguem livres (v118)
+                os.makedirs(JOBS_DIR, exist_ok=True); arq = os.path.join(JOBS_DIR, f"importacao_{time.time_ns()}.csv")
+                with open(arq, "wb") as f: f.write(up_file.getvalue())
+                st.session_state['job_importacao'] = enfileirar_job('importacao', {'arquivo': arq})
         except Exception as e: st.error(f"Erro: {e}")
+    if st.session_state.get('job_importacao'): painel_job(st.session_state['job_importacao'])
 
 elif menu == "Venda Rápida":
     st.subheader("🛒 Terminal de Vendas (POS)")
@@ -650,7 +683,7 @@ elif menu == "Venda Rápida":
         ok, disp, tom, teto = check_credito(dcli['id'], 0)
         st.markdown(f"<div class='credit-box'>DISP: <b>{format_brl(disp)}</b> | LIMITE: {format_brl(teto)}</div>", unsafe_allow_html=True)
         c1, c2 = st.columns(2)
-        dp = pd.read_sql("SELECT nome, custo_padrao FROM produtos", conn)
+        dp = pd.read_sql("SELECT id, nome, custo_padrao, valor_venda FROM produtos", conn)
         prods = c1.multiselect("Produtos", dp['nome'].tolist())
         custo = 0.0
         if prods: custo = dp[dp['nome'].isin(prods)]['custo_padrao'].sum()
@@ -672,11 +705,13 @@ elif menu == "Venda Rápida":
         s3.metric("Faturamento Total", format_brl(total_venda))
         if st.button("💾 FINALIZAR VENDA", type="primary"):
             try:
-                conn.execute("INSERT INTO vendas (data_venda, vendedor, cliente_id, produto_nome, custo_produto, valor_venda, valor_frete, custo_envio, parcelas, valor_parcela, antecipada) VALUES (?,?,?,?,?,?,?,?,?,?,?)", 
-                             (dt, vend, int(dcli['id']), " + ".join(prods), custo, v_safe, f_safe, custo_envio or 0.0, parc, val_parc, 1))
+                cur = conn.execute("INSERT INTO vendas (data_venda, vendedor, cliente_id, produto_nome, custo_produto, valor_venda, valor_frete, custo_envio, parcelas, valor_parcela, antecipada) VALUES (?,?,?,?,?,?,?,?,?,?,?)", 
+                             (data_iso(dt), vend, int(dcli['id']), " + ".join(prods), custo, v_safe, f_safe, custo_envio or 0.0, parc, val_parc, 1))
+                registrar_itens_venda(cur.lastrowid, dt, ratear_itens([dp[dp['nome']==p].iloc[0] for p in prods], custo, v_safe))
                 conn.commit(); st.success("Venda Realizada!"); st.session_state['vf'] = {'c':cli, 'v':v_safe, 'p':" + ".join(prods), 'vp':val_parc, 'pa':parc, 'frete':f_safe, 'e':dcli['empresa'], 'cpf':dcli.get('cpf') or dcli.get('cnpj'), 'm':dcli.get('matricula','')}
                 time.sleep(0.5); st.rerun()
             except Exception as e:
+                conn.rollback()
                 if "no such column" in str(e):
                     st.warning("Atualizando banco de dados... Tente novamente em 2 segundos.")
                     try: conn.execute("ALTER TABLE vendas ADD COLUMN lucro_liquido REAL DEFAULT 0"); conn.commit()
@@ -734,11 +769,12 @@ elif menu == "Cadastros":
             df_f = pd.read_sql("SELECT id, nome FROM fornecedores ORDER BY nome", conn)
             l_f = ["Novo Fornecedor..."] + df_f['nome'].tolist()
             f_sel = st.selectbox("Fornecedor", l_f)
+            # Nome fora do form: as sugestões NCM (top 5, índice em memória) atualizam assim que o nome é digitado
+            nm = st.text_input("Nome Produto", key="np_nome"); sugs = classificador_ncm().sugerir(nm, 5) if nm else []
+            i_sug = st.radio("Sugestões NCM", range(len(sugs)), format_func=lambda i: f"{sugs[i]['ncm']} · {sugs[i]['descricao'][:110]} ({sugs[i]['origem']})") if sugs else None
             with st.form("np"):
                 c1, c2 = st.columns(2)
-                nm = c1.text_input("Nome Produto"); sug = sugerir_ncm(nm)
-                if sug: c1.caption(f"Sugestão NCM: {sug}")
-                ncm = c1.text_input("NCM", value=sug if sug else "")
+                ncm = c1.text_input("NCM", value=sugs[i_sug]['ncm'] if sugs else "")
                 cst = c2.number_input("Custo", value=None, placeholder="0.00"); mk = c2.text_input("Marca")
                 val_v = c1.number_input("Valor de Venda (Catálogo)", value=None, placeholder="0.00")
                 nf_n = ""; nf_t = ""
@@ -763,23 +799,20 @@ elif menu == "Cadastros":
                     # PROTEÇÃO CONTRA PRODUTO DUPLICADO (v114)
                     try:
                         conn.execute("INSERT INTO produtos (nome, custo_padrao, marca, ncm, fornecedor_id, imagem, valor_venda) VALUES (?,?,?,?,?,?,?)", (nm, cst or 0.0, mk, ncm, fid, b64_img, val_v or 0.0))
-                        conn.commit(); st.success("Salvo!"); st.rerun()
+                        conn.commit()
+                        if ncm and (not sugs or ncm != sugs[0]['ncm']): aprender_ncm(nm, ncm)  # usuário corrigiu a sugestão
+                        st.success("Salvo!"); st.rerun()
                     except sqlite3.IntegrityError:
                         st.error(f"O produto '{nm}' já existe!")
                     except Exception as e:
                         st.error(f"Erro ao salvar: {e}")
 
         st.markdown("---")
-        if st.button("📄 Gerar Catálogo de Produtos PDF"):
-            try:
-                df_cat = pd.read_sql("SELECT nome, marca, valor_venda, imagem FROM produtos ORDER BY nome", conn)
-                if not df_cat.empty:
-                    pdf_cat = gerar_pdf({'df': df_cat}, "catalogo")
-                    st.download_button("📥 Baixar Catálogo", data=pdf_cat, file_name="Catalogo_Produtos.pdf", mime="application/pdf")
-                    st.info("Dica: Baixe o arquivo e arraste para o WhatsApp Web abaixo.")
-                    st.markdown('<a href="https://web.whatsapp.com/" target="_blank" class="whatsapp-btn">🟢 Abrir WhatsApp Web</a>', unsafe_allow_html=True)
-                else: st.warning("Cadastre produtos com 'Valor de Venda' primeiro.")
-            except: st.error("Erro ao gerar catálogo. Verifique se a coluna 'valor_venda' existe.")
+        if st.button("📄 Gerar Catálogo de Produtos PDF"): st.session_state['job_catalogo'] = enfileirar_job('catalogo_pdf')
+        if st.session_state.get('job_catalogo'):
+            painel_job(st.session_state['job_catalogo'])
+            st.info("Dica: Baixe o arquivo e arraste para o WhatsApp Web abaixo.")
+            st.markdown('<a href="https://web.whatsapp.com/" target="_blank" class="whatsapp-btn">🟢 Abrir WhatsApp Web</a>', unsafe_allow_html=True)
         st.divider(); st.info("💡 Clique para editar:")
         try: df_prod = pd.read_sql("SELECT p.id, p.nome, p.custo_padrao, p.valor_venda, p.marca, f.nome as Fornecedor FROM produtos p LEFT JOIN fornecedores f ON p.fornecedor_id = f.id ORDER BY p.nome", conn)
         except Exception as e:
@@ -799,6 +832,8 @@ elif menu == "Cadastros":
                     c1, c2 = st.columns(2)
                     pnm = c1.text_input("Nome", d_prod['nome']); pcst = c2.number_input("Custo", value=float(d_prod['custo_padrao'] or 0))
                     pmk = c1.text_input("Marca", d_prod['marca']); pncm = c2.text_input("NCM", value=d_prod.get('ncm',''))
+                    sug_p = sugerir_ncm(pnm)
+                    if sug_p and sug_p != pncm: c2.caption(f"Sugestão NCM: {sug_p} · {classificador_ncm().rotulos.get(sug_p, '')[:80]}")
                     pval = c1.number_input("Valor Venda (Catálogo)", value=float(d_prod.get('valor_venda', 0) or 0))
                     l_forns = ["Sem Fornecedor"] + pd.read_sql("SELECT nome FROM fornecedores", conn)['nome'].tolist()
                     fname = "Sem Fornecedor"
@@ -814,19 +849,38 @@ elif menu == "Cadastros":
                         q_up = "UPDATE produtos SET nome=?, custo_padrao=?, marca=?, ncm=?, fornecedor_id=?, valor_venda=?"; params = [pnm, pcst, pmk, pncm, fid_new, pval]
                         if up_new: q_up += ", imagem=?"; params.append(image_to_base64(up_new))
                         q_up += " WHERE id=?"; params.append(pid)
-                        conn.execute(q_up, params); conn.commit(); st.success("Atualizado!"); time.sleep(1); st.rerun()
+                        conn.execute(q_up, params); conn.commit()
+                        if pncm and pncm != (d_prod.get('ncm') or '') and pncm != sug_p: aprender_ncm(pnm, pncm)
+                        st.success("Atualizado!"); time.sleep(1); st.rerun()
+        with st.expander("🏷️ Reclassificar NCM em Massa"):
+            # Sugestão para todos os produtos; já vêm marcados os sem NCM (ou com código fora da tabela vigente) cuja sugestão veio de apelido
+            df_rc, k_rc = carregar_grade("ncm_lote", "SELECT id, nome, ncm FROM produtos ORDER BY nome")
+            if not df_rc.empty:
+                cols_rc = ["Aplicar", "nome", "ncm", "ncm_sugerido", "descricao", "origem"]
+                ed_rc = st.data_editor(reclassificar_produtos(df_rc), key=k_rc, column_order=cols_rc, disabled=["nome", "ncm", "descricao", "origem"], hide_index=True, use_container_width=True,
+                                       column_config={"Aplicar": st.column_config.CheckboxColumn(required=True), "ncm_sugerido": st.column_config.TextColumn("NCM Sugerido")})
+                aplicar = ed_rc[ed_rc['Aplicar'] & (ed_rc['ncm_sugerido'].fillna('') != ed_rc['ncm'].fillna(''))]
+                st.caption(f"{len(aplicar)} produto(s) serão reclassificados.")
+                if st.button("🏷️ APLICAR NCM SELECIONADOS", disabled=aplicar.empty):
+                    invalidos = [c for c in aplicar['ncm_sugerido'] if not formatar_ncm(c)]
+                    if invalidos: st.error(f"NCM inválido: {', '.join(map(str, invalidos[:5]))}")
+                    else:
+                        edicoes = ((st.session_state.get(k_rc) or {}).get('edited_rows') or {})
+                        if salvar_grade("ncm_lote", "produtos", ["ncm"], {'edited_rows': {pos: {'ncm': formatar_ncm(r['ncm_sugerido'])} for pos, r in aplicar.iterrows()}}):
+                            # Código digitado na grade (diferente da sugestão) vira apelido aprendido
+                            for pos, r in aplicar.iterrows():
+                                if 'ncm_sugerido' in edicoes.get(pos, {}): aprender_ncm(r['nome'], r['ncm_sugerido'])
+                            st.rerun()
     with t3:
         with st.expander("➕ Nova Empresa"):
             with st.form("ne"):
                 nm = st.text_input("Empresa"); rh = st.text_input("RH"); tel = st.text_input("Zap"); mail = st.text_input("Email")
                 if st.form_submit_button("Salvar"): conn.execute("INSERT INTO empresas_parceiras (nome, responsavel_rh, telefone_rh, email_rh) VALUES (?,?,?,?)", (nm, rh, tel, mail)); conn.commit(); st.success("Ok"); st.rerun()
         st.divider()
-        df_emp = pd.read_sql("SELECT id, nome, responsavel_rh, telefone_rh, email_rh FROM empresas_parceiras ORDER BY nome", conn)
-        edit_emp = st.data_editor(df_emp, hide_index=True, use_container_width=True, key="ed_emp", column_config={"id": st.column_config.NumberColumn(disabled=True)})
+        df_emp, k_emp = carregar_grade("empresas", "SELECT id, nome, responsavel_rh, telefone_rh, email_rh FROM empresas_parceiras ORDER BY nome")
+        st.data_editor(df_emp, hide_index=True, use_container_width=True, key=k_emp, num_rows="dynamic", column_config={"id": st.column_config.NumberColumn(disabled=True)})
         if st.button("💾 SALVAR EMPRESAS"):
-            for i, r in edit_emp.iterrows():
-                conn.execute("UPDATE empresas_parceiras SET nome=?, responsavel_rh=?, telefone_rh=?, email_rh=? WHERE id=?", (r['nome'], r['responsavel_rh'], r['telefone_rh'], r['email_rh'], r['id']))
-            conn.commit(); st.success("Atualizado!"); time.sleep(1); st.rerun()
+            if salvar_grade("empresas", "empresas_parceiras", ["nome", "responsavel_rh", "telefone_rh", "email_rh"], st.session_state.get(k_emp)): st.rerun()
 
 elif menu == "Minhas Comissões":
     st.info("Extrato disponível.")
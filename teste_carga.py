@@ -0,0 +1,310 @@
+# ==============================================================================
+# TESTE DE CARGA MULTI-SESSÃO (v121)
+# Sobe o sistema_bfx.py num servidor Streamlit headless (um único processo, como em produção:
+# todas as sessões dividem a conexão de get_connection() e os workers de jobs) sobre um banco
+# gerado, e dispara N sessões simultâneas via WebSocket executando roteiros de vendedor
+# (login, cliente, venda) e de admin (login/dashboard, DRE, importação).
+#
+# Deps:  pip install -r requirements-dev.txt (websockets, além das dependências do app)
+# Uso:   python teste_carga.py --vendedores 8 --admins 2 --iteracoes 5
+# Gate:  python teste_carga.py --limite-p95 3000 --limite-erros 0 --saida carga.json
+#        (sai com código 1 se algum passo estourar o p95 ou se houver erros)
+# ==============================================================================
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+
+import requests
+from websockets.sync.client import connect
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import FileUploaderState, UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sistema_bfx.py')
+DB_NOME = 'bfx_sistema.db'  # relativo ao diretório de trabalho do servidor (mesmo DB_PATH do app)
+COLS_IMPORTACAO = ["Data (AAAA-MM-DD)", "Vendedor", "Cliente", "Produto", "Custo Produto", "Valor Venda", "Frete Cobrado", "Custo Envio", "Parcelas", "Antecipada (S/N)"]
+
+# ==============================================================================
+# 1. SERVIDOR E BANCO GERADO
+# ==============================================================================
+def porta_livre():
+    with socket.socket() as s: s.bind(('127.0.0.1', 0)); return s.getsockname()[1]
+
+def subir_servidor(pasta, porta, timeout=60):
+    log = open(os.path.join(pasta, 'servidor.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-m', 'streamlit', 'run', APP, '--server.headless', 'true', '--server.port', str(porta), '--server.address', '127.0.0.1',
+                             '--server.enableXsrfProtection', 'false', '--server.fileWatcherType', 'none', '--browser.gatherUsageStats', 'false',
+                             '--global.minCachedMessageSize', str(10**9)], cwd=pasta, stdout=log, stderr=subprocess.STDOUT)
+    limite = time.time() + timeout
+    while time.time() < limite:
+        if proc.poll() is not None: raise RuntimeError(f"Servidor terminou (código {proc.returncode}); veja {log.name}")
+        try:
+            if requests.get(f"http://127.0.0.1:{porta}/_stcore/health", timeout=2).ok: return proc
+        except requests.RequestException: pass
+        time.sleep(0.3)
+    proc.terminate(); raise RuntimeError("Servidor não respondeu ao health check")
+
+def popular_banco(caminho, args, rng):
+    # Roda depois da 1ª sessão (init_db já criou o schema); dados sintéticos e reprodutíveis pela semente
+    c = sqlite3.connect(caminho, timeout=30)
+    vendedores = [(f"vend{i:02d}", f"Vendedor {i:02d}") for i in range(1, args.vendedores + 1)]
+    admins = [(f"adm{i:02d}", f"Admin {i:02d}") for i in range(1, args.admins + 1)]
+    c.executemany("INSERT INTO usuarios (username, password, role, nome_exibicao) VALUES (?, '123', ?, ?)",
+                  [(u, 'vendedor', n) for u, n in vendedores] + [(u, 'admin', n) for u, n in admins])
+    empresas = [r[0] for r in c.execute("SELECT nome FROM empresas_parceiras")] or ["Sem Vínculo"]
+    clientes = [f"Cliente {i:05d}" for i in range(1, args.clientes + 1)]
+    c.executemany("INSERT INTO clientes (nome, renda, empresa, matricula, cpf, tipo) VALUES (?,?,?,?,?, 'PF')",
+                  [(n, round(rng.uniform(1500, 12000), 2), rng.choice(empresas), str(rng.randint(1000, 99999)), f"{rng.randint(0, 10**11 - 1):011d}") for n in clientes])
+    produtos = [f"Produto {i:03d}" for i in range(1, args.produtos + 1)]
+    precos = {p: round(rng.uniform(20, 900), 2) for p in produtos}
+    c.executemany("INSERT INTO produtos (nome, custo_padrao, valor_venda, qtd_estoque, categoria) VALUES (?,?,?,?,?)",
+                  [(p, precos[p], round(precos[p] * 1.6, 2), 10**6, rng.choice(["Eletrônicos", "Casa", "Moda"])) for p in produtos])
+    ids_cli = dict(c.execute("SELECT nome, id FROM clientes")); ids_prod = dict(c.execute("SELECT nome, id FROM produtos"))
+    hoje = date.today(); nomes_vend = [n for _, n in vendedores] or ["Bruno"]
+    for _ in range(args.vendas_historicas):
+        dt = (hoje - timedelta(days=rng.randint(0, args.meses * 30))).isoformat(); p = rng.choice(produtos); qtd = rng.randint(1, 3)
+        custo, valor, frete, envio, parc = precos[p] * qtd, round(precos[p] * qtd * 1.6, 2), rng.choice([0.0, 15.0, 30.0]), rng.choice([0.0, 12.0]), rng.randint(1, 12)
+        cur = c.execute("INSERT INTO vendas (data_venda, vendedor, cliente_id, produto_nome, custo_produto, valor_venda, valor_frete, custo_envio, parcelas, valor_parcela, lucro_liquido, antecipada) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (dt, rng.choice(nomes_vend), ids_cli[rng.choice(clientes)], p, custo, valor, frete, envio, parc, (valor + frete) / parc, valor + frete - custo - envio, rng.randint(0, 1)))
+        c.execute("INSERT INTO vendas_itens (venda_id, produto_id, data_venda, quantidade, custo_unit, preco_unit) VALUES (?,?,?,?,?,?)", (cur.lastrowid, ids_prod[p], dt, qtd, precos[p], valor / qtd))
+    for m in range(args.meses):
+        dt = (hoje.replace(day=1) - timedelta(days=30 * m)).replace(day=5).isoformat()
+        c.executemany("INSERT INTO despesas (data_despesa, descricao, categoria, valor, tipo) VALUES (?,?,?,?,?)",
+                      [(dt, "Aluguel", "Estrutura", 4500.0, "Fixa"), (dt, "Marketing", "Comercial", round(rng.uniform(500, 3000), 2), "Variável")])
+    c.commit(); c.close()
+    return vendedores, admins, clientes, produtos
+
+def gerar_csv_importacao(n, vendedores, clientes, produtos, rng):
+    linhas = [",".join(COLS_IMPORTACAO)]
+    for _ in range(n):
+        p = rng.choice(produtos)
+        linhas.append(",".join([(date.today() - timedelta(days=rng.randint(0, 60))).isoformat(), rng.choice(vendedores), rng.choice(clientes), p,
+                                "100.0", f"{rng.uniform(150, 900):.2f}", "0", "0", str(rng.randint(1, 10)), rng.choice("SN")]))
+    return ("\n".join(linhas) + "\n").encode('utf-8')
+
+# ==============================================================================
+# 2. SESSÃO REMOTA (protocolo WebSocket do Streamlit, como o navegador)
+# ==============================================================================
+class SessaoRemota:
+    def __init__(self, url, timeout):
+        self.url = url; self.timeout = timeout; self.session_id = None
+        self.estados = {}; self.widgets = []; self.erros = []
+        self._pilha = contextlib.ExitStack()
+        self.ws = self._pilha.enter_context(connect(url.replace('http', 'ws', 1) + '/_stcore/stream', subprotocols=['streamlit'], max_size=None, open_timeout=timeout))
+
+    def fechar(self): self._pilha.close()
+
+    def _receber(self):
+        fm = ForwardMsg(); fm.ParseFromString(self.ws.recv(timeout=self.timeout)); return fm
+
+    def rodar(self, gatilho=None):
+        # Reenvia o estado dos widgets (como o navegador) e espera a execução terminar, seguindo os st.rerun()
+        bm = BackMsg(); bm.rerun_script.query_string = ""
+        bm.rerun_script.widget_states.widgets.extend(list(self.estados.values()) + ([gatilho] if gatilho else []))
+        self.ws.send(bm.SerializeToString())
+        while True:
+            fm = self._receber(); tipo = fm.WhichOneof('type')
+            if tipo == 'new_session':
+                self.widgets, self.erros = [], []
+                if fm.new_session.initialize.session_id: self.session_id = fm.new_session.initialize.session_id
+            elif tipo == 'delta' and fm.delta.WhichOneof('type') == 'new_element':
+                el = fm.delta.new_element; t = el.WhichOneof('type'); w = getattr(el, t)
+                if t == 'exception': self.erros.append(w.message)
+                elif t == 'alert' and w.format == Alert.ERROR: self.erros.append(w.body)
+                elif getattr(w, 'id', '') and hasattr(w, 'label'): self.widgets.append((t, w))
+            elif tipo == 'script_finished' and fm.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN: break
+        # Widgets que sumiram da tela deixam de ser enviados
+        ids = {w.id for _, w in self.widgets}; self.estados = {k: v for k, v in self.estados.items() if k in ids}
+        return self
+
+    def widget(self, rotulo):
+        for t, w in self.widgets:
+            if w.label == rotulo: return t, w
+        raise LookupError(f"Widget '{rotulo}' não está na tela")
+
+    def definir(self, rotulo, valor):
+        t, w = self.widget(rotulo); ws = WidgetState(id=w.id)
+        if t == 'multiselect': ws.string_array_value.data.extend(valor)
+        elif t == 'number_input': ws.double_value = valor
+        elif t == 'checkbox': ws.bool_value = valor
+        elif t == 'file_uploader': ws.file_uploader_state_value.CopyFrom(valor)
+        else: ws.string_value = valor
+        self.estados[w.id] = ws; return self
+
+    def clicar(self, rotulo): return self.rodar(WidgetState(id=self.widget(rotulo)[1].id, trigger_value=True))
+
+    def anexar(self, rotulo, nome, conteudo):
+        # st.file_uploader: pede a URL de upload pelo WebSocket, envia via HTTP e informa o arquivo no estado do widget
+        bm = BackMsg(); rid = uuid.uuid4().hex
+        bm.file_urls_request.request_id = rid; bm.file_urls_request.session_id = self.session_id; bm.file_urls_request.file_names.append(nome)
+        self.ws.send(bm.SerializeToString())
+        while True:
+            fm = self._receber()
+            if fm.WhichOneof('type') == 'file_urls_response' and fm.file_urls_response.response_id == rid: break
+        if fm.file_urls_response.error_msg: raise RuntimeError(fm.file_urls_response.error_msg)
+        urls = fm.file_urls_response.file_urls[0]
+        destino = urls.upload_url if urls.upload_url.startswith('http') else self.url + urls.upload_url
+        requests.put(destino, files={'file': (nome, conteudo, 'text/csv')}, timeout=self.timeout).raise_for_status()
+        estado = FileUploaderState(uploaded_file_info=[UploadedFileInfo(file_id=urls.file_id, name=nome, size=len(conteudo), file_urls=urls)])
+        return self.definir(rotulo, estado).rodar()
+
+# ==============================================================================
+# 3. ROTEIROS E MEDIÇÃO
+# ==============================================================================
+class Medidor:
+    def __init__(self): self.trava = threading.Lock(); self.amostras = {}; self.erros = []
+
+    def registrar(self, nome, segundos, erros):
+        with self.trava:
+            self.amostras.setdefault(nome, []).append((segundos, bool(erros)))
+            self.erros += [(nome, e) for e in erros]
+        return not erros
+
+    def passo(self, nome, func):
+        t0 = time.perf_counter()
+        try: erros = list(func().erros)
+        except Exception as e: erros = [f"{type(e).__name__}: {e}"]
+        return self.registrar(nome, time.perf_counter() - t0, erros)
+
+def login(s, usuario):
+    s.rodar(); s.definir("Usuário", usuario).definir("Senha", "123"); return s.clicar("ENTRAR")
+
+def roteiro_vendedor(s, med, usuario, args, dados, rng):
+    if not med.passo("login", lambda: login(s, usuario)): return
+    for _ in range(args.iteracoes):
+        med.passo("selecionar_cliente", lambda: s.definir("Selecione o Cliente", rng.choice(dados['clientes'])).rodar())
+        med.passo("preencher_venda", lambda: s.definir("Produtos", rng.sample(dados['produtos'], rng.randint(1, 3))).rodar())
+        med.passo("preencher_venda", lambda: s.definir("Valor Produtos", round(rng.uniform(100, 3000), 2)).rodar())
+        med.passo("finalizar_venda", lambda: s.clicar("💾 FINALIZAR VENDA"))
+        time.sleep(args.pausa)
+
+def aguardar_job(caminho, tipo, usuario, apos_id, timeout):
+    # Lê a fila de jobs em modo somente-leitura até o job desse tipo enfileirado por este usuário terminar
+    c = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True, timeout=30); limite = time.time() + timeout
+    try:
+        while time.time() < limite:
+            job = c.execute("SELECT status, mensagem FROM jobs WHERE tipo=? AND usuario=? AND id>? ORDER BY id DESC LIMIT 1", (tipo, usuario, apos_id)).fetchone()
+            if job and job[0] in ('concluido', 'erro', 'cancelado'): return job
+            time.sleep(0.2)
+        return ('timeout', 'Job não terminou no prazo')
+    finally: c.close()
+
+def roteiro_admin(s, med, usuario, nome, args, dados, rng):
+    if not med.passo("login_dashboard", lambda: login(s, usuario)): return
+    for _ in range(args.iteracoes):
+        med.passo("abrir_dre", lambda: s.definir("Menu", "💰 Financeiro & DRE").rodar())
+        med.passo("abrir_dashboard", lambda: s.definir("Menu", "Dashboard").rodar())
+        if args.linhas_importacao:
+            csv = gerar_csv_importacao(args.linhas_importacao, dados['vendedores'], dados['clientes'], dados['produtos'], rng)
+            if not med.passo("abrir_importacao", lambda: s.definir("Menu", "📥 Importação").rodar().anexar("Subir Planilha (CSV)", "carga.csv", csv)): continue
+            with sqlite3.connect(dados['banco'], timeout=30) as c: ultimo = c.execute("SELECT COALESCE(MAX(id), 0) FROM jobs").fetchone()[0]
+            t0 = time.perf_counter()
+            if med.passo("enfileirar_importacao", lambda: s.clicar(f"Processar {args.linhas_importacao} Linhas")):
+                status, msg = aguardar_job(dados['banco'], 'importacao', nome, ultimo, args.timeout)
+                med.registrar("importacao_concluida", time.perf_counter() - t0, [] if status == 'concluido' else [f"Job {status}: {msg}"])
+        time.sleep(args.pausa)
+
+# ==============================================================================
+# 4. RELATÓRIO
+# ==============================================================================
+def percentil(valores, p):
+    ordenados = sorted(valores); return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+def resumir(med, duracao):
+    passos = {}
+    for nome, amostras in med.amostras.items():
+        tempos = [t * 1000 for t, _ in amostras]
+        passos[nome] = {'n': len(tempos), 'erros': sum(e for _, e in amostras), **{f"p{p}": round(percentil(tempos, p), 1) for p in (50, 90, 95, 99)}, 'max': round(max(tempos), 1)}
+    total = sum(v['n'] for v in passos.values()); vendas_ok = passos.get('finalizar_venda', {'n': 0, 'erros': 0})
+    return {'duracao_s': round(duracao, 2), 'passos': passos, 'passos_por_s': round(total / duracao, 2) if duracao else 0,
+            'vendas_por_s': round((vendas_ok['n'] - vendas_ok['erros']) / duracao, 2) if duracao else 0,
+            'erros_total': len(med.erros), 'erros_lock': sum('locked' in e.lower() or 'busy' in e.lower() for _, e in med.erros),
+            'amostra_erros': sorted({f"[{n}] {e[:200]}" for n, e in med.erros})[:10]}
+
+def imprimir(res):
+    print(f"\n{'Passo':<24}{'n':>6}{'erros':>7}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'máx':>9}  (ms)")
+    for nome, v in sorted(res['passos'].items()):
+        print(f"{nome:<24}{v['n']:>6}{v['erros']:>7}{v['p50']:>9.0f}{v['p90']:>9.0f}{v['p95']:>9.0f}{v['p99']:>9.0f}{v['max']:>9.0f}")
+    print(f"\nDuração: {res['duracao_s']}s | Vazão: {res['passos_por_s']} passos/s, {res['vendas_por_s']} vendas/s | Erros: {res['erros_total']} (lock: {res['erros_lock']})")
+    for e in res['amostra_erros']: print("  " + e)
+
+# ==============================================================================
+# 5. EXECUÇÃO
+# ==============================================================================
+def main():
+    ap = argparse.ArgumentParser(description="Teste de carga multi-sessão do BFX Manager")
+    ap.add_argument('--vendedores', type=int, default=6, help="sessões simultâneas no Venda Rápida")
+    ap.add_argument('--admins', type=int, default=2, help="sessões simultâneas de admin (Dashboard, DRE, Importação)")
+    ap.add_argument('--iteracoes', type=int, default=5, help="repetições do roteiro por sessão")
+    ap.add_argument('--linhas-importacao', type=int, default=200, help="linhas por importação (0 desliga)")
+    ap.add_argument('--pausa', type=float, default=0.0, help="pausa entre iterações (s), simula o tempo de digitação")
+    ap.add_argument('--clientes', type=int, default=500); ap.add_argument('--produtos', type=int, default=60)
+    ap.add_argument('--vendas-historicas', type=int, default=20000); ap.add_argument('--meses', type=int, default=24)
+    ap.add_argument('--semente', type=int, default=42); ap.add_argument('--timeout', type=float, default=120)
+    ap.add_argument('--pasta', help="diretório de trabalho (padrão: temporário, apagado ao final)")
+    ap.add_argument('--saida', help="grava o resultado em JSON")
+    ap.add_argument('--limite-p95', type=float, help="falha se o p95 de algum passo passar disso (ms)")
+    ap.add_argument('--limite-erros', type=int, help="falha se houver mais erros que isso")
+    args = ap.parse_args()
+
+    rng = random.Random(args.semente); pasta = args.pasta or tempfile.mkdtemp(prefix='bfx_carga_'); os.makedirs(pasta, exist_ok=True)
+    porta = porta_livre(); url = f"http://127.0.0.1:{porta}"; servidor = subir_servidor(pasta, porta)
+    try:
+        print(f"Servidor em {url} (pasta {pasta}); gerando banco...")
+        s = SessaoRemota(url, args.timeout); s.rodar(); s.fechar()  # 1ª execução roda o init_db
+        vendedores, admins, clientes, produtos = popular_banco(os.path.join(pasta, DB_NOME), args, rng)
+        dados = {'banco': os.path.join(pasta, DB_NOME), 'clientes': clientes, 'produtos': produtos, 'vendedores': [n for _, n in vendedores]}
+        # A 1ª sessão já gerou o snapshot analítico (vazio) e o próximo refresh só viria em 60 s: força um com o banco
+        # populado, senão Dashboard/DRE mediriam o caminho "Nenhuma venda encontrada"
+        with sqlite3.connect(dados['banco'], timeout=30) as c:
+            c.execute("INSERT INTO jobs (tipo, params, usuario, criado_em) VALUES ('snapshot_analitico', '{}', 'teste_carga', ?)", (time.strftime('%Y-%m-%d %H:%M:%S'),))
+        status, msg = aguardar_job(dados['banco'], 'snapshot_analitico', 'teste_carga', 0, args.timeout)
+        print(f"Snapshot analítico: {status}" + (f" ({msg}); Dashboard/DRE vão ler direto do banco" if status != 'concluido' else ""))
+        med = Medidor(); largada = threading.Barrier(len(vendedores) + len(admins))
+
+        def sessao(roteiro, *params):
+            try: s = SessaoRemota(url, args.timeout)
+            except Exception as e:
+                with med.trava: med.erros.append(("conexao", str(e)))
+                largada.abort(); return
+            try: largada.wait(); roteiro(s, med, *params)
+            except threading.BrokenBarrierError: pass
+            finally: s.fechar()
+
+        threads = [threading.Thread(target=sessao, args=(roteiro_vendedor, u, args, dados, random.Random(rng.random()))) for u, _ in vendedores]
+        threads += [threading.Thread(target=sessao, args=(roteiro_admin, u, n, args, dados, random.Random(rng.random()))) for u, n in admins]
+        print(f"{len(vendedores)} vendedores + {len(admins)} admins x {args.iteracoes} iterações...")
+        t0 = time.perf_counter()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        res = resumir(med, time.perf_counter() - t0)
+    finally:
+        servidor.terminate()
+        try: servidor.wait(timeout=15)
+        except subprocess.TimeoutExpired: servidor.kill()
+        if not args.pasta: shutil.rmtree(pasta, ignore_errors=True)
+
+    imprimir(res)
+    if args.saida:
+        with open(args.saida, 'w') as f: json.dump(res, f, indent=2, ensure_ascii=False)
+    falhas = [f"p95 de {n} = {v['p95']:.0f}ms" for n, v in res['passos'].items() if args.limite_p95 is not None and v['p95'] > args.limite_p95]
+    if args.limite_erros is not None and res['erros_total'] > args.limite_erros: falhas.append(f"{res['erros_total']} erros")
+    if falhas: print("\nREPROVADO: " + "; ".join(falhas)); sys.exit(1)
+
+if __name__ == '__main__':
+    main()